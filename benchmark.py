@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Performance regression gate for the search stack
+Runs a fixed, seeded set of benchmarks (chunking, embedding, lab 3 search
+at several corpus sizes, lab 4 ingest/query, lab 1 keyword search) and
+compares them to benchmark_baseline.json. Exits with status 1 when any
+metric is worse than its baseline by more than the metric's tolerance, or
+when a measured metric has no recorded baseline (unless --allow-missing).
+
+Usage:
+    python benchmark.py                          # compare against the baseline
+    python benchmark.py --skip embedding,lab4    # no model download needed
+    python benchmark.py --update-baseline        # record this machine's numbers
+    python benchmark.py --allow-missing          # report metrics without a baseline, don't fail
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import contextlib
+import numpy as np
+from load_test import generate_corpus, generate_queries
+
+BASELINE_PATH = "benchmark_baseline.json"
+GROUPS = ("chunking", "embedding", "lab3", "lab4", "lab1")
+LAB3_SIZES = (1000, 10000, 50000)
+
+# metric -> (higher_is_better, default tolerance as a fraction of the baseline)
+METRICS = {
+    "chunking.smart_chunk_mb_per_s": (True, 0.40),
+    "embedding.texts_per_s": (True, 0.25),
+    **{f"lab3.search_p50_ms@{n}": (False, 0.40) for n in LAB3_SIZES},
+    "lab4.ingest_chunks_per_s": (True, 0.30),
+    "lab4.query_p50_ms": (False, 0.40),
+    "lab4.query_p95_ms": (False, 0.50),
+    "lab1.keyword_query_p50_ms": (False, 0.40),
+}
+
+def best_seconds(fn, repeats=5, min_total=1.0):
+    """Fastest of at least `repeats` timed runs spanning min_total seconds (the least noisy throughput estimate)"""
+    timings = []
+    while len(timings) < repeats or sum(timings) < min_total:
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def latencies_ms(fn, inputs, warmup=3):
+    """Per-call latencies in ms for fn over inputs, after a few untimed calls"""
+    for item in inputs[:warmup]:
+        fn(item)
+    timings = []
+    for item in inputs:
+        start = time.perf_counter()
+        fn(item)
+        timings.append((time.perf_counter() - start) * 1000)
+    return np.array(timings)
+
+def bench_chunking(documents):
+    """Throughput of smart_chunk_document over the whole corpus"""
+    from lab4_vector_database import smart_chunk_document
+    
+    total_bytes = sum(len(doc['content']) for doc in documents)
+    
+    def chunk_all():
+        for doc in documents:
+            smart_chunk_document(doc['content'], doc['source'], chunk_size=500, overlap_sentences=2)
+    
+    return {"chunking.smart_chunk_mb_per_s": total_bytes / 2**20 / best_seconds(chunk_all)}
+
+def bench_embedding(documents, n_texts=256):
+    """Texts per second through the sentence-transformers model (loaded before timing)"""
+    from lab4_vector_database import get_embedding_model, smart_chunk_document
+    
+    texts = [chunk['text'] for doc in documents for chunk in smart_chunk_document(doc['content'], doc['source'])]
+    texts = texts[:n_texts]
+    model = get_embedding_model()
+    model.encode(texts[:8])
+    seconds = best_seconds(lambda: model.encode(texts, batch_size=64, convert_to_numpy=True), repeats=3)
+    return {"embedding.texts_per_s": len(texts) / seconds}
+
+def bench_lab3(seed, sizes=LAB3_SIZES, n_queries=100):
+    """VectorDatabase.search latency at several corpus sizes (precomputed query vectors, no model)"""
+    from lab3_similarity_search import VectorDatabase
+    
+    rng = np.random.default_rng(seed)
+    matrix = rng.standard_normal((max(sizes), 384), dtype=np.float32)
+    queries = rng.standard_normal((n_queries, 384), dtype=np.float32)
+    results = {}
+    for size in sizes:
+        db = VectorDatabase.from_arrays([f"doc {i}" for i in range(size)], ["bench"] * size, matrix[:size])
+        timings = latencies_ms(lambda query: db.search_vector(query, top_k=3, min_similarity=0.0), queries)
+        results[f"lab3.search_p50_ms@{size}"] = float(np.percentile(timings, 50))
+    return results
+
+def bench_lab4(folder, queries, workdir):
+    """Ingest throughput and search_documents latency against a fresh Chroma store"""
+    from lab4_vector_database import setup_chromadb, load_and_chunk_documents, search_documents
+    
+    store_path = os.path.join(workdir, "chroma_db")
+    with contextlib.redirect_stdout(io.StringIO()):
+        _, collection = setup_chromadb(store_path=store_path)
+        start = time.perf_counter()
+        chunks = load_and_chunk_documents(folder, collection)
+        ingest_seconds = time.perf_counter() - start
+    
+    timings = latencies_ms(lambda query: search_documents(collection, query, n_results=3), queries)
+    return {
+        "lab4.ingest_chunks_per_s": chunks / ingest_seconds,
+        "lab4.query_p50_ms": float(np.percentile(timings, 50)),
+        "lab4.query_p95_ms": float(np.percentile(timings, 95)),
+    }
+
+def bench_lab1(documents, queries):
+    """sql_search latency over the corpus loaded into an in-memory policies table"""
+    from lab1_the_search_problem import sql_search
+    
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE policies (id INTEGER PRIMARY KEY, title TEXT, content TEXT)")
+    conn.executemany("INSERT INTO policies (title, content) VALUES (?, ?)",
+                     [(doc['title'], doc['content']) for doc in documents])
+    conn.commit()
+    timings = latencies_ms(lambda query: sql_search(conn, query), queries)
+    conn.close()
+    return {"lab1.keyword_query_p50_ms": float(np.percentile(timings, 50))}
+
+def run_benchmarks(groups=GROUPS, n_docs=300, seed=42):
+    """Run the selected benchmark groups on a generated corpus; returns {metric: value}"""
+    from lab4_vector_database import load_documents_from_folder
+    
+    workdir = tempfile.mkdtemp(prefix="benchmark_")
+    try:
+        folder = os.path.join(workdir, "docs")
+        generate_corpus(folder, n_docs, seed=seed)
+        with contextlib.redirect_stdout(io.StringIO()):
+            documents = load_documents_from_folder(folder)
+        queries = generate_queries(100, seed)
+        
+        results = {}
+        for group in groups:
+            print(f"⏱️  {group}...", flush=True)
+            if group == "chunking":
+                results.update(bench_chunking(documents))
+            elif group == "embedding":
+                results.update(bench_embedding(documents))
+            elif group == "lab3":
+                results.update(bench_lab3(seed))
+            elif group == "lab4":
+                results.update(bench_lab4(folder, queries, workdir))
+            elif group == "lab1":
+                results.update(bench_lab1(documents, queries))
+        return results
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "system": platform.system(),
+        "cpu_count": os.cpu_count()
+    }
+
+def compare(results, baseline, allow_missing=False):
+    """
+    (metric, baseline, current, change, tolerance, status) rows.
+    
+    change is the fractional difference in the "worse" direction, so a
+    positive change means slower; status is ok, improved, REGRESSION,
+    skipped, or NO BASELINE for a measured metric whose baseline is missing
+    or null (a failure; "no baseline" when allow_missing).
+    """
+    rows = []
+    for metric, (higher_is_better, default_tolerance) in METRICS.items():
+        entry = baseline.get("metrics", {}).get(metric, {})
+        expected = entry.get("value")
+        tolerance = entry.get("tolerance", default_tolerance)
+        current = results.get(metric)
+        if current is None:
+            rows.append((metric, expected, None, None, tolerance, "skipped"))
+            continue
+        if expected is None:
+            rows.append((metric, None, current, None, tolerance, "no baseline" if allow_missing else "NO BASELINE"))
+            continue
+        change = (expected - current) / expected if higher_is_better else (current - expected) / expected
+        if change > tolerance:
+            status = "REGRESSION"
+        elif change < -tolerance:
+            status = "improved"
+        else:
+            status = "ok"
+        rows.append((metric, expected, current, change, tolerance, status))
+    return rows
+
+def update_baseline(baseline, results):
+    """Copy measured values into the baseline, keeping any tuned tolerances"""
+    metrics = baseline.setdefault("metrics", {})
+    for metric, (higher_is_better, default_tolerance) in METRICS.items():
+        entry = metrics.setdefault(metric, {"value": None, "tolerance": default_tolerance})
+        entry["higher_is_better"] = higher_is_better
+        if metric in results:
+            entry["value"] = round(results[metric], 4)
+    baseline["environment"] = environment()
+    baseline["updated"] = time.strftime('%Y-%m-%d')
+    return baseline
+
+def print_comparison(rows):
+    print(f"\n{'metric':32} {'baseline':>11} {'current':>11} {'change':>8} {'tol':>5}  status")
+    print("-" * 80)
+    for metric, expected, current, change, tolerance, status in rows:
+        expected_text = "-" if expected is None else f"{expected:11.3f}"
+        current_text = "-" if current is None else f"{current:11.3f}"
+        change_text = "-" if change is None else f"{change:+.0%}"
+        icon = {"REGRESSION": "❌", "NO BASELINE": "❌", "improved": "🚀", "ok": "✅"}.get(status, "➖")
+        print(f"{metric:32} {expected_text:>11} {current_text:>11} {change_text:>8} {tolerance:5.0%}  {icon} {status}")
+
+def main():
+    """Command line entry point; exit status 1 on any regression or missing baseline"""
+    parser = argparse.ArgumentParser(description="Benchmark regression gate for the search stack")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Baseline JSON to compare against")
+    parser.add_argument("--only", help=f"Comma-separated groups to run ({','.join(GROUPS)})")
+    parser.add_argument("--skip", help="Comma-separated groups to leave out")
+    parser.add_argument("--docs", type=int, default=300, help="Generated corpus size")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="Write this run's values into the baseline instead of gating")
+    parser.add_argument("--allow-missing", action="store_true",
+                        help="Do not fail on measured metrics that have no baseline value")
+    parser.add_argument("--json", metavar="PATH", help="Also write the raw results as JSON")
+    args = parser.parse_args()
+    
+    groups = args.only.split(",") if args.only else list(GROUPS)
+    if args.skip:
+        groups = [group for group in groups if group not in args.skip.split(",")]
+    unknown = set(groups) - set(GROUPS)
+    if unknown:
+        parser.error(f"unknown benchmark group(s): {', '.join(sorted(unknown))}")
+    
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    
+    print(f"🏁 Benchmarks: {', '.join(groups)} ({args.docs} docs, seed {args.seed})")
+    results = run_benchmarks(groups, args.docs, args.seed)
+    
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"environment": environment(), "results": results}, f, indent=2)
+    
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(update_baseline(baseline, results), f, indent=2)
+            f.write("\n")
+        print(f"💾 Baseline updated: {args.baseline}")
+        return 0
+    
+    if baseline.get("environment", {}) != environment():
+        print(f"⚠️  Baseline was recorded on {baseline.get('environment')}; timings may not be comparable")
+    
+    rows = compare(results, baseline, args.allow_missing)
+    print_comparison(rows)
+    regressions = [row[0] for row in rows if row[5] == "REGRESSION"]
+    missing = [row[0] for row in rows if row[5] == "NO BASELINE"]
+    if regressions:
+        print(f"\n❌ {len(regressions)} regression(s): {', '.join(regressions)}")
+    if missing:
+        print(f"\n❌ {len(missing)} metric(s) without a baseline: {', '.join(missing)}")
+        print("   Record them with --update-baseline, or pass --allow-missing")
+    if regressions or missing:
+        return 1
+    print("\n✅ No regressions")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
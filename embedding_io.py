@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Embedding bundles: move precomputed vectors between machines without inference
+
+A bundle is a .npy (or .npz with a 'vectors' array) of shape (n, dims) plus a
+JSONL sidecar. The sidecar's first line is a header with the model tag and
+dimensions; every following line is {"id", "text", "metadata"} for the
+matching vector row.
+
+Usage:
+    python embedding_io.py import policies.npy policies.jsonl
+    python embedding_io.py export policies.npy policies.jsonl
+    python embedding_io.py import policies.npy policies.jsonl --lab3-index index.npz
+"""
+
+import json
+import argparse
+import numpy as np
+
+BUNDLE_FORMAT = "embedding-bundle"
+BUNDLE_VERSION = 1
+
+class BundleError(ValueError):
+    """Raised when a bundle does not match what the importer expects"""
+
+def read_header(sidecar_path):
+    """Read and check the header line of a JSONL sidecar"""
+    with open(sidecar_path, 'r', encoding='utf-8') as f:
+        header = json.loads(f.readline() or '{}')
+    if header.get('format') != BUNDLE_FORMAT:
+        raise BundleError(f"{sidecar_path} is not an {BUNDLE_FORMAT} sidecar (missing header line)")
+    return header
+
+def count_records(sidecar_path):
+    """Number of non-blank record lines after the header (no JSON parsing)"""
+    with open(sidecar_path, 'r', encoding='utf-8') as f:
+        f.readline()  # header
+        return sum(1 for line in f if line.strip())
+
+def open_vectors(vectors_path):
+    """Open the vector file; .npy is memory-mapped so batches stream from disk"""
+    if vectors_path.endswith('.npz'):
+        with np.load(vectors_path, allow_pickle=False) as data:
+            return data['vectors']
+    return np.load(vectors_path, mmap_mode='r', allow_pickle=False)
+
+def read_bundle(vectors_path, sidecar_path, expected_model=None, expected_dims=None, batch_size=1000):
+    """
+    Validate a bundle and yield (ids, texts, metadatas, vectors) batches.
+    
+    Raises BundleError if the model tag, dimensions or row counts disagree.
+    """
+    header = read_header(sidecar_path)
+    vectors = open_vectors(vectors_path)
+    
+    if vectors.ndim != 2:
+        raise BundleError(f"Expected a 2-D vector array, got shape {vectors.shape}")
+    if expected_model is not None and header.get('model') != expected_model:
+        raise BundleError(f"Bundle was embedded with {header.get('model')!r}, expected {expected_model!r}")
+    if header.get('dims') != vectors.shape[1]:
+        raise BundleError(f"Header says {header.get('dims')} dims but vectors have {vectors.shape[1]}")
+    if expected_dims is not None and vectors.shape[1] != expected_dims:
+        raise BundleError(f"Vectors have {vectors.shape[1]} dims, expected {expected_dims}")
+    if header.get('count') != len(vectors):
+        raise BundleError(f"Header says {header.get('count')} rows but vectors have {len(vectors)}")
+    # Count sidecar records before yielding anything, so a short or long
+    # sidecar is rejected before the caller has written any batch
+    records = count_records(sidecar_path)
+    if records != len(vectors):
+        raise BundleError(f"Sidecar has {records} records but vectors have {len(vectors)} rows")
+    
+    ids, texts, metadatas = [], [], []
+    row = 0
+    with open(sidecar_path, 'r', encoding='utf-8') as f:
+        f.readline()  # header
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            ids.append(record['id'])
+            texts.append(record.get('text', ''))
+            metadatas.append(record.get('metadata') or {})
+            if len(ids) == batch_size:
+                yield ids, texts, metadatas, np.asarray(vectors[row:row + len(ids)], dtype=np.float32)
+                row += len(ids)
+                ids, texts, metadatas = [], [], []
+    if ids:
+        yield ids, texts, metadatas, np.asarray(vectors[row:row + len(ids)], dtype=np.float32)
+
+class BundleWriter:
+    """
+    Stream batches into a bundle: vectors go to a preallocated .npy memmap,
+    records are appended to the JSONL sidecar.
+    """
+    
+    def __init__(self, vectors_path, sidecar_path, model_name, dims, count):
+        self.vectors = np.lib.format.open_memmap(vectors_path, mode='w+', dtype=np.float32,
+                                                 shape=(count, dims))
+        self.sidecar = open(sidecar_path, 'w', encoding='utf-8')
+        self.sidecar.write(json.dumps({
+            'format': BUNDLE_FORMAT,
+            'version': BUNDLE_VERSION,
+            'model': model_name,
+            'dims': dims,
+            'count': count
+        }) + '\n')
+        self.count = count
+        self.row = 0
+    
+    def write_batch(self, ids, texts, metadatas, vectors):
+        """Append one batch of rows"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.row + len(vectors) > self.count:
+            raise BundleError(f"Writing more than the declared {self.count} rows")
+        self.vectors[self.row:self.row + len(vectors)] = vectors
+        for record_id, text, metadata in zip(ids, texts, metadatas):
+            self.sidecar.write(json.dumps({'id': record_id, 'text': text, 'metadata': metadata or {}}) + '\n')
+        self.row += len(vectors)
+    
+    def close(self):
+        """Flush both files; fails if fewer rows were written than declared"""
+        self.vectors.flush()
+        del self.vectors
+        self.sidecar.close()
+        if self.row != self.count:
+            raise BundleError(f"Declared {self.count} rows but wrote {self.row}")
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.sidecar.close()
+
+def main():
+    """Command line import/export for the lab 4 Chroma collection (or a lab 3 index)"""
+    parser = argparse.ArgumentParser(description="Import or export precomputed embeddings")
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("vectors", help="Vector file (.npy, or .npz with a 'vectors' array)")
+    parser.add_argument("sidecar", help="JSONL sidecar with ids, texts and metadata")
+    parser.add_argument("--store", default="./chroma_db", help="ChromaDB persistence directory")
+    parser.add_argument("--lab3-index", metavar="NPZ",
+                        help="Use a lab 3 VectorDatabase .npz index instead of ChromaDB")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    
+    if args.lab3_index:
+        import os
+        from lab3_similarity_search import VectorDatabase
+        
+        if args.command == "import":
+            db = VectorDatabase.load(args.lab3_index) if os.path.exists(args.lab3_index) else VectorDatabase()
+            added = db.import_bundle(args.vectors, args.sidecar, batch_size=args.batch_size)
+            db.save(args.lab3_index)
+            print(f"✅ Imported {added} vectors into {args.lab3_index}")
+        else:
+            db = VectorDatabase.load(args.lab3_index)
+            db.export_bundle(args.vectors, args.sidecar, batch_size=args.batch_size)
+            print(f"✅ Exported {len(db.documents)} vectors to {args.vectors} + {args.sidecar}")
+        return
+    
+    from lab4_vector_database import setup_chromadb, import_embeddings, export_embeddings
+    
+    client, collection = setup_chromadb(warm_start=True, store_path=args.store)
+    if args.command == "import":
+        added = import_embeddings(collection, args.vectors, args.sidecar, batch_size=args.batch_size)
+        print(f"✅ Imported {added} vectors into {args.store}")
+    else:
+        exported = export_embeddings(collection, args.vectors, args.sidecar, batch_size=args.batch_size)
+        print(f"✅ Exported {exported} vectors to {args.vectors} + {args.sidecar}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Multi-process embedding pool
+N worker processes, each with its own model copy, write vectors straight into
+a shared-memory output array instead of pickling them back.
+"""
+
+import os
+import time
+import queue
+import threading
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+def attach_shared_memory(name):
+    """Attach to an existing block without letting this process's tracker unlink it"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13: spawned workers share the parent's resource tracker,
+        # so the extra registration is a no-op and the parent's unlink clears it
+        return shared_memory.SharedMemory(name=name)
+
+def worker_main(model_name, threads, tasks, events):
+    """Worker loop: load the model once, then embed batches until the None sentinel"""
+    # Pin BLAS/OpenMP threads before torch is imported
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        os.environ[var] = str(threads)
+    try:
+        import torch
+        from sentence_transformers import SentenceTransformer
+        
+        torch.set_num_threads(threads)
+        model = SentenceTransformer(model_name)
+        events.put(('ready', os.getpid(), model.get_sentence_embedding_dimension()))
+    except Exception as e:
+        events.put(('error', os.getpid(), f"model load failed: {e!r}"))
+        return
+    
+    blocks = {}
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        job_id, shm_name, shape, start, texts = task
+        try:
+            if shm_name not in blocks:
+                # A new job means earlier output blocks are finished with
+                for block in blocks.values():
+                    block.close()
+                blocks = {shm_name: attach_shared_memory(shm_name)}
+            output = np.ndarray(shape, dtype=np.float32, buffer=blocks[shm_name].buf)
+            output[start:start + len(texts)] = model.encode(
+                texts, batch_size=len(texts), convert_to_numpy=True
+            )
+            events.put(('done', job_id, len(texts)))
+        except Exception as e:
+            events.put(('failed', job_id, repr(e)))
+    
+    for block in blocks.values():
+        block.close()
+
+class EmbeddingPool:
+    """
+    Pool of embedding worker processes.
+    
+    Batches go on one shared task queue, so an idle worker always takes the
+    next batch (no worker sits idle while another has a backlog). Each batch
+    writes its rows in place, so results come back in input order. encode()
+    holds a lock for the whole job, so concurrent callers from several
+    threads run one job at a time instead of consuming each other's events.
+    Use as a context manager, or call close(), for a clean shutdown.
+    """
+    
+    def __init__(self, n_workers=None, model_name="all-MiniLM-L6-v2", threads_per_worker=1,
+                 batch_size=64, start_timeout=300):
+        self.n_workers = n_workers or max(1, (os.cpu_count() or 1) // threads_per_worker)
+        self.model_name = model_name
+        self.threads_per_worker = threads_per_worker
+        self.batch_size = batch_size
+        self.start_timeout = start_timeout
+        self.context = mp.get_context('spawn')
+        self.tasks = self.context.Queue()
+        self.events = self.context.Queue()
+        self.workers = []
+        self.dims = None
+        self.next_job = 0
+        self.encode_lock = threading.Lock()
+    
+    def start(self):
+        """Spawn the workers and wait until every model is loaded"""
+        for _ in range(self.n_workers):
+            worker = self.context.Process(
+                target=worker_main,
+                args=(self.model_name, self.threads_per_worker, self.tasks, self.events),
+                daemon=True
+            )
+            worker.start()
+            self.workers.append(worker)
+        
+        ready = 0
+        deadline = time.monotonic() + self.start_timeout
+        while ready < self.n_workers:
+            try:
+                kind, _, payload = self.events.get(timeout=1)
+            except queue.Empty:
+                if time.monotonic() > deadline or not all(worker.is_alive() for worker in self.workers):
+                    self.close()
+                    raise RuntimeError("Embedding workers did not start")
+                continue
+            if kind == 'error':
+                self.close()
+                raise RuntimeError(f"Embedding worker failed to start: {payload}")
+            self.dims = payload
+            ready += 1
+        return self
+    
+    def encode(self, texts, out=None):
+        """Embed texts across all workers; returns an (n, dims) float32 array in input order"""
+        texts = list(texts)
+        with self.encode_lock:
+            if not self.workers:
+                self.start()
+            return self._encode_job(texts, out)
+    
+    def _encode_job(self, texts, out):
+        """Run one job; the caller holds encode_lock, so every event belongs to it"""
+        shape = (len(texts), self.dims)
+        if out is None:
+            out = np.empty(shape, dtype=np.float32)
+        if not texts:
+            return out
+        
+        block = shared_memory.SharedMemory(create=True, size=len(texts) * self.dims * 4)
+        try:
+            job_id = self.next_job
+            self.next_job += 1
+            for start in range(0, len(texts), self.batch_size):
+                self.tasks.put((job_id, block.name, shape, start, texts[start:start + self.batch_size]))
+            
+            remaining = len(texts)
+            while remaining:
+                try:
+                    kind, event_job, payload = self.events.get(timeout=1)
+                except queue.Empty:
+                    if not all(worker.is_alive() for worker in self.workers):
+                        raise RuntimeError("An embedding worker died mid-job")
+                    continue
+                if event_job != job_id:
+                    continue
+                if kind == 'failed':
+                    raise RuntimeError(f"Embedding batch failed: {payload}")
+                remaining -= payload
+            
+            out[:] = np.ndarray(shape, dtype=np.float32, buffer=block.buf)
+        finally:
+            block.close()
+            block.unlink()
+        return out
+    
+    def close(self, timeout=10):
+        """Send one sentinel per worker and wait for them to exit"""
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        self.workers = []
+    
+    def __enter__(self):
+        return self.start()
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
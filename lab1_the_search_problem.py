@@ -6,12 +6,17 @@ A simple demonstration showing why SQL LIKE search doesn't understand meaning
 
 import sqlite3
 import os
+import json
+import queue
+import pathlib
+import contextlib
 
 def create_database():
     """Create a SQLite database with our company handbook"""
-    # Remove old database if it exists
-    if os.path.exists('company_handbook.db'):
-        os.remove('company_handbook.db')
+    # Remove old database (and any WAL side files) if it exists
+    for path in ('company_handbook.db', 'company_handbook.db-wal', 'company_handbook.db-shm'):
+        if os.path.exists(path):
+            os.remove(path)
     
     # Create new database
     conn = sqlite3.connect('company_handbook.db')
@@ -37,8 +42,61 @@ def create_database():
     conn.commit()
     return conn
 
+def create_vector_table(conn):
+    """Add a table of float32 embedding BLOBs next to the policies (WAL mode)"""
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS policy_vectors (
+            policy_id INTEGER NOT NULL REFERENCES policies(id),
+            model TEXT NOT NULL,
+            dims INTEGER NOT NULL,
+            vector BLOB NOT NULL,
+            PRIMARY KEY (policy_id, model)
+        )
+    ''')
+    conn.commit()
+
+def store_embeddings(conn, policy_ids, vectors, model_name):
+    """Bulk-insert embeddings as raw float32 bytes in a single transaction"""
+    import numpy as np
+    
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if len(vectors) == 0:
+        return
+    dims = vectors.shape[1]
+    rows = ((int(policy_id), model_name, dims, vector.tobytes())
+            for policy_id, vector in zip(policy_ids, vectors))
+    
+    with conn:
+        conn.executemany('''
+            INSERT OR REPLACE INTO policy_vectors (policy_id, model, dims, vector)
+            VALUES (?, ?, ?, ?)
+        ''', rows)
+
+def load_vector_matrix(conn, model_name):
+    """
+    Load every embedding for a model as (policy_ids, matrix).
+    
+    The BLOBs are concatenated once and viewed with numpy.frombuffer, so
+    there is no per-row Python float conversion. The matrix is read-only.
+    """
+    import numpy as np
+    
+    rows = conn.execute('''
+        SELECT policy_id, dims, vector FROM policy_vectors
+        WHERE model = ? ORDER BY policy_id
+    ''', (model_name,)).fetchall()
+    
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+    
+    dims = rows[0][1]
+    policy_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    matrix = np.frombuffer(b''.join(row[2] for row in rows), dtype=np.float32)
+    return policy_ids, matrix.reshape(len(rows), dims)
+
 def sql_search(conn, query):
-    """Search using SQL LIKE - the traditional way"""
+    """Search using SQL LIKE - the traditional way; returns (results, words, sql, params)"""
     cursor = conn.cursor()
     
     # Extract meaningful words from query
@@ -51,10 +109,14 @@ def sql_search(conn, query):
         if clean_word not in skip_words:
             search_words.append(clean_word)
     
-    # Build SQL query
+    # Build a parameterized SQL query: the text only depends on the word count,
+    # so sqlite3's statement cache reuses the compiled statement
     conditions = []
+    params = []
     for word in search_words:
-        conditions.append(f"LOWER(content) LIKE '%{word}%'")
+        conditions.append("LOWER(content) LIKE ? ESCAPE '\\'")
+        escaped = word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        params.append(f"%{escaped}%")
     
     if conditions:
         sql = f"SELECT title, content FROM policies WHERE {' OR '.join(conditions)}"
@@ -62,10 +124,115 @@ def sql_search(conn, query):
         sql = "SELECT title, content FROM policies WHERE 1=0"
     
     # Execute the actual query
-    cursor.execute(sql)
+    cursor.execute(sql, params)
     results = cursor.fetchall()
     
-    return results, search_words, sql
+    return results, search_words, sql, params
+
+def display_sql(sql, params):
+    """The statement with each ? shown as its quoted parameter (for printing only, never execute it)"""
+    parts = sql.split('?')
+    shown = [parts[0]]
+    for param, part in zip(params, parts[1:]):
+        shown.append("'" + str(param).replace("'", "''") + "'" + part)
+    return ''.join(shown)
+
+class ReadPool:
+    """
+    Thread-safe pool of read-only SQLite connections to one database file.
+    
+    The file is switched to WAL mode so readers never block on (or block) a
+    writer. Each connection gets a memory map and a larger page cache, and
+    keeps its compiled statements cached. A thread borrows a connection for
+    the duration of one call, so concurrent lookups never share one.
+    The file must already exist: a missing database raises
+    sqlite3.OperationalError here instead of being created empty.
+    """
+    
+    def __init__(self, db_path='company_handbook.db', size=4, mmap_size=256 * 2**20,
+                 cache_size_kb=64 * 1024, timeout=30):
+        self.db_path = db_path
+        # mode=rw opens an existing file only (plain connect() would create it)
+        self.uri = pathlib.Path(db_path).absolute().as_uri() + '?mode=rw'
+        self.mmap_size = mmap_size
+        self.cache_size_kb = cache_size_kb
+        self.timeout = timeout
+        self.use_json_each = True
+        
+        # journal_mode=WAL is stored in the file, so one writable connection sets it for all
+        conn = sqlite3.connect(self.uri, timeout=timeout, uri=True)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.close()
+        
+        self.idle = queue.LifoQueue()
+        self.connections = [self.connect() for _ in range(size)]
+        for conn in self.connections:
+            self.idle.put(conn)
+    
+    def connect(self):
+        conn = sqlite3.connect(self.uri, timeout=self.timeout, check_same_thread=False,
+                               cached_statements=256, uri=True)
+        conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+        conn.execute(f'PRAGMA cache_size={-int(self.cache_size_kb)}')
+        conn.execute('PRAGMA query_only=ON')
+        return conn
+    
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a connection, waiting up to timeout seconds for one to come free"""
+        try:
+            conn = self.idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No free connection after {self.timeout}s") from None
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+    
+    def search(self, query):
+        """sql_search on a pooled connection"""
+        with self.connection() as conn:
+            return sql_search(conn, query)
+    
+    def fetch_policies(self, policy_ids):
+        """
+        Fetch many policies by id in one query: {policy_id: (title, content)}.
+        
+        The ids travel as one JSON array parameter, so every batch size runs
+        the same cached statement. Ids that do not exist are left out.
+        """
+        policy_ids = [int(policy_id) for policy_id in policy_ids]
+        if not policy_ids:
+            return {}
+        with self.connection() as conn:
+            if self.use_json_each:
+                try:
+                    rows = conn.execute(
+                        'SELECT id, title, content FROM policies WHERE id IN (SELECT value FROM json_each(?))',
+                        (json.dumps(policy_ids),)
+                    ).fetchall()
+                    return {row[0]: row[1:] for row in rows}
+                except sqlite3.OperationalError:
+                    # SQLite built without the JSON1 functions
+                    self.use_json_each = False
+            rows = []
+            for start in range(0, len(policy_ids), 500):
+                batch = policy_ids[start:start + 500]
+                rows += conn.execute(
+                    f"SELECT id, title, content FROM policies WHERE id IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+        return {row[0]: row[1:] for row in rows}
+    
+    def close(self):
+        for conn in self.connections:
+            conn.close()
+        self.connections = []
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
 
 def main():
     """Run the interactive demonstration"""
@@ -105,9 +272,9 @@ def main():
     query1 = "Tell me about jeans and business casual"
     print(f'\nEmployee asks: "{query1}"')
     
-    results, words, sql = sql_search(conn, query1)
+    results, words, sql, params = sql_search(conn, query1)
     print(f"\n📝 SQL Query executed:")
-    print(f"   {sql[:100]}...")
+    print(f"   {display_sql(sql, params)[:100]}...")
     print(f"\n🔎 Searched for words: {words}")
     
     if results:
@@ -129,9 +296,9 @@ def main():
     query2 = "What are the clothing rules?"
     print(f'\nEmployee asks: "{query2}"')
     
-    results, words, sql = sql_search(conn, query2)
+    results, words, sql, params = sql_search(conn, query2)
     print(f"\n📝 SQL Query executed:")
-    print(f"   {sql[:100]}...")
+    print(f"   {display_sql(sql, params)[:100]}...")
     print(f"\n🔎 Searched for words: {words}")
     
     if results:
@@ -155,9 +322,9 @@ def main():
     query3 = "What should I wear to work?"
     print(f'\nEmployee asks: "{query3}"')
     
-    results, words, sql = sql_search(conn, query3)
+    results, words, sql, params = sql_search(conn, query3)
     print(f"\n📝 SQL Query executed:")
-    print(f"   {sql[:100]}...")
+    print(f"   {display_sql(sql, params)[:100]}...")
     print(f"\n🔎 Searched for words: {words}")
     
     if results:
@@ -4,8 +4,8 @@ Lab 2: Understanding Embeddings with Real AI Models
 Using sentence-transformers to show how text becomes meaningful vectors
 """
 
-import numpy as np
 from sentence_transformers import SentenceTransformer
+from similarity import cosine_similarity, one_to_many, rowwise
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -29,13 +29,6 @@ def visualize_embedding_slice(embedding, start=0, end=10):
         print(f"{val:+.1f}", end=" ")
     print()
 
-def cosine_similarity(vec1, vec2):
-    """Calculate cosine similarity between two vectors"""
-    dot_product = np.dot(vec1, vec2)
-    norm1 = np.linalg.norm(vec1)
-    norm2 = np.linalg.norm(vec2)
-    return dot_product / (norm1 * norm2)
-
 def main():
     print("=" * 70)
     print("🤖 LAB 2: REAL AI EMBEDDINGS")
@@ -64,11 +57,12 @@ def main():
     print("\nLet's compare similar concepts:")
     print("-" * 50)
     
-    for word1, word2 in word_pairs:
-        emb1 = model.encode(word1)
-        emb2 = model.encode(word2)
-        similarity = cosine_similarity(emb1, emb2)
-        
+    # Encode every word in one batch, then score each pair row by row
+    pair_embeddings = model.encode([word for pair in word_pairs for word in pair])
+    pair_similarities = rowwise(pair_embeddings[0::2], pair_embeddings[1::2])
+    
+    for (word1, word2), emb1, emb2, similarity in zip(
+            word_pairs, pair_embeddings[0::2], pair_embeddings[1::2], pair_similarities):
         print(f'\n📝 "{word1}" vs "{word2}"')
         print(f"   Similarity: {similarity:.1%}")
         
@@ -154,10 +148,10 @@ But the result?
     print("=" * 50)
     print("Watch how the AI accurately scores relevance!")
     
-    for query in queries:
-        query_embedding = model.encode(query)
-        similarity = cosine_similarity(policy_embedding, query_embedding)
-        
+    # One-to-many: score the policy against every query at once
+    query_similarities = one_to_many(policy_embedding, model.encode(queries))
+    
+    for query, similarity in zip(queries, query_similarities):
         print(f'\n❓ "{query}"')
         print(f"   Similarity to dress code policy: {similarity:.1%}")
         
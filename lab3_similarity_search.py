@@ -4,11 +4,22 @@ Lab 3: Similarity Search - Finding Meaning with Math
 Shows how vector similarity finds relevant content using cosine similarity
 """
 
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from collections import namedtuple
 import numpy as np
 from sentence_transformers import SentenceTransformer
+from profiling import Profiler, profile_stage, start_stage
+from lab1_the_search_problem import create_vector_table, load_vector_matrix, store_embeddings
+from similarity import as_compute_array, blas_threads, one_to_many, row_norms, top_k as top_k_search
 import warnings
 warnings.filterwarnings('ignore')
 
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+
 # Global model instance to avoid reloading
 model = None
 
@@ -17,7 +28,7 @@ def get_embedding_model():
     global model
     if model is None:
         print("Loading AI model (this takes a few seconds)...")
-        model = SentenceTransformer('all-MiniLM-L6-v2')
+        model = SentenceTransformer(EMBEDDING_MODEL_NAME)
         print("✅ Model loaded!\n")
     return model
 
@@ -26,58 +37,855 @@ def get_embedding(text):
     model = get_embedding_model()
     return model.encode(text)
 
-def cosine_similarity(vec1, vec2):
-    """Calculate cosine similarity between two vectors"""
-    dot_product = np.dot(vec1, vec2)
-    norm1 = np.linalg.norm(vec1)
-    norm2 = np.linalg.norm(vec2)
+# Number of set bits for every possible byte value (fallback when NumPy lacks bitwise_count)
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def pack_sign_bits(vectors):
+    """Quantize vectors to one bit per dimension (1 = positive): 384 dims -> 48 bytes"""
+    return np.packbits(np.asarray(vectors) > 0, axis=-1)
+
+def hamming_distances(codes, query_code):
+    """Hamming distance from one packed code to every row of a packed code matrix"""
+    xor = np.bitwise_xor(codes, query_code)
+    # Popcount 8 bytes at a time when the code width allows it
+    if xor.shape[1] % 8 == 0:
+        xor = np.ascontiguousarray(xor).view(np.uint64)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(xor).sum(axis=1, dtype=np.int32)
+    return POPCOUNT_TABLE[xor.view(np.uint8)].sum(axis=1, dtype=np.int32)
+
+# An immutable view of the database: readers only ever touch rows < count
+Snapshot = namedtuple('Snapshot', ['matrix', 'norms', 'count'])
+
+# k-means partitions over the first `count` rows; vectors holds the unit rows
+# grouped by partition, partition p spanning offsets[p]:offsets[p + 1]
+Partitions = namedtuple('Partitions', ['count', 'centroids', 'radii', 'rows', 'offsets', 'vectors'])
+
+def unit_rows(matrix, norms):
+    """Rows scaled to unit length (zero rows stay zero)"""
+    safe = np.where(norms == 0, 1, norms).astype(np.float32)
+    return np.asarray(matrix, dtype=np.float32) / safe[:, None]
+
+def unit_vector(vector):
+    """A single vector scaled to unit length as float32 (None if it is all zeros)"""
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return None if norm == 0 else vector / norm
+
+def nearest_centroids(vectors, centroids, block_size=65536):
+    """Index of the highest-dot-product centroid for every row, in blocks"""
+    assignment = np.empty(len(vectors), dtype=np.intp)
+    for start in range(0, len(vectors), block_size):
+        assignment[start:start + block_size] = np.argmax(vectors[start:start + block_size] @ centroids.T, axis=1)
+    return assignment
+
+def partition_means(vectors, assignment, n_partitions):
+    """Mean row of each partition plus the partition-sorted row order and offsets"""
+    order = np.argsort(assignment, kind='stable')
+    counts = np.bincount(assignment, minlength=n_partitions)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    means = np.zeros((n_partitions, vectors.shape[1]), dtype=np.float32)
+    nonempty = counts > 0
+    means[nonempty] = np.add.reduceat(vectors[order], offsets[:-1][nonempty]) / counts[nonempty, None]
+    return means, order, offsets
+
+def grow(array, needed):
+    """Copy array into one with at least `needed` rows (doubling); the old one stays valid for readers"""
+    if needed <= len(array):
+        return array
+    grown = np.empty((max(needed, 2 * len(array)),) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+class TextColumn:
+    """
+    Append-only strings stored as one UTF-8 byte buffer plus an offsets array.
+    
+    Row i is buffer[offsets[i]:offsets[i + 1]] and is only decoded when read.
+    Behaves like a read-only list: len(), indexing, slicing and iteration.
+    """
+    __slots__ = ('buffer', 'offsets', 'count')
+    
+    def __init__(self, texts=()):
+        self.buffer = np.empty(0, dtype=np.uint8)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.count = 0
+        self.extend(texts)
+    
+    @classmethod
+    def from_buffers(cls, buffer, offsets):
+        """Wrap existing buffer/offsets arrays (e.g. loaded from disk) without copying"""
+        column = cls()
+        column.buffer = np.asarray(buffer, dtype=np.uint8)
+        column.offsets = np.asarray(offsets, dtype=np.int64)
+        column.count = len(column.offsets) - 1
+        return column
+    
+    def extend(self, texts):
+        """Append texts; growth copies into new arrays so readers keep valid views"""
+        encoded = [text.encode('utf-8') for text in texts]
+        if not encoded:
+            return
+        joined = b''.join(encoded)
+        used = self.offsets[self.count]
+        buffer = grow(self.buffer, used + len(joined))
+        offsets = grow(self.offsets, self.count + len(encoded) + 1)
+        buffer[used:used + len(joined)] = np.frombuffer(joined, dtype=np.uint8)
+        offsets[self.count + 1:self.count + 1 + len(encoded)] = used + np.cumsum([len(e) for e in encoded])
+        self.buffer, self.offsets = buffer, offsets
+        self.count += len(encoded)
+    
+    def __len__(self):
+        return self.count
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.count))]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("TextColumn index out of range")
+        offsets = self.offsets
+        return self.buffer[offsets[index]:offsets[index + 1]].tobytes().decode('utf-8')
     
-    if norm1 == 0 or norm2 == 0:
-        return 0.0
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
     
-    return dot_product / (norm1 * norm2)
+    def compact_arrays(self):
+        """(buffer, offsets) trimmed to the stored rows"""
+        return self.buffer[:self.offsets[self.count]], self.offsets[:self.count + 1]
+    
+    def nbytes(self):
+        """Bytes allocated for the buffer and offsets"""
+        return {'text_buffer': self.buffer.nbytes, 'text_offsets': self.offsets.nbytes}
+
+class CategoryColumn:
+    """
+    Dictionary-encoded strings: each distinct value is stored once and rows
+    hold a small integer code (uint8, widened as the dictionary grows).
+    """
+    __slots__ = ('values', 'lookup', 'codes', 'count')
+    
+    def __init__(self, categories=()):
+        self.values = []
+        self.lookup = {}
+        self.codes = np.empty(0, dtype=np.uint8)
+        self.count = 0
+        self.extend(categories)
+    
+    @classmethod
+    def from_codes(cls, values, codes):
+        """Wrap an existing dictionary and code array"""
+        column = cls()
+        column.values = list(values)
+        column.lookup = {value: code for code, value in enumerate(column.values)}
+        column.codes = np.asarray(codes)
+        column.count = len(column.codes)
+        return column
+    
+    def extend(self, categories):
+        """Append categories, adding unseen values to the dictionary"""
+        new_codes = [self.lookup.setdefault(c, len(self.lookup)) for c in categories]
+        if not new_codes:
+            return
+        self.values.extend(list(self.lookup)[len(self.values):])
+        dtype = np.min_scalar_type(max(len(self.values) - 1, 0))
+        codes = grow(self.codes, self.count + len(new_codes))
+        if np.dtype(dtype).itemsize > codes.dtype.itemsize:
+            codes = codes.astype(dtype)
+        codes[self.count:self.count + len(new_codes)] = new_codes
+        self.codes = codes
+        self.count += len(new_codes)
+    
+    def __len__(self):
+        return self.count
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.values[code] for code in self.codes[:self.count][index].tolist()]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("CategoryColumn index out of range")
+        return self.values[self.codes[index]]
+    
+    def __iter__(self):
+        for code in self.codes[:self.count].tolist():
+            yield self.values[code]
+    
+    def nbytes(self):
+        """Bytes allocated for the codes and the distinct values"""
+        return {'category_codes': self.codes.nbytes,
+                'category_values': sum(len(value.encode('utf-8')) for value in self.values)}
 
 class VectorDatabase:
-    """Simple vector database for semantic search"""
+    """
+    Simple vector database for semantic search
+    
+    Searches never lock. Each one reads self.snapshot once: a matrix view,
+    its norms and a row count. Writers serialize on write_lock, fill rows
+    past the published count in preallocated storage, then publish a new
+    snapshot with a single attribute assignment. Growth, compaction and
+    derived indexes (sign bits, PCA rows) are built off to the side and
+    published the same way, so readers never see torn state.
+    
+    dtype=np.float16 halves vector memory and bandwidth; scoring upcasts
+    blocks to float32 on the fly. search_threads caps BLAS threads for
+    every search (each search method also takes a per-call threads=).
+    Capped searches take similarity.blas_lock and so run one at a time;
+    concurrent servers should call similarity.set_blas_threads() once.
+    """
+    
+    def __init__(self, initial_capacity=1024, dtype=np.float32, search_threads=None):
+        if np.dtype(dtype) not in (np.float16, np.float32):
+            raise ValueError(f"dtype must be float16 or float32, got {np.dtype(dtype)}")
+        self.dtype = np.dtype(dtype)
+        self.search_threads = search_threads
+        self.documents = TextColumn()        # append-only, rows >= snapshot.count are not yet published
+        self.categories = CategoryColumn()
+        self.write_lock = threading.Lock()
+        self.initial_capacity = initial_capacity
+        self.storage = None        # (capacity, dims) in self.dtype, rows >= count are free
+        self.norm_storage = None
+        self.snapshot = Snapshot(np.empty((0, 0), dtype=self.dtype), np.empty(0, dtype=np.float32), 0)
+        self.binary_index = None   # (count, packed sign bits of the first count rows)
+        self.pca = None            # (mean, components) fitted by fit_pca()
+        self.pca_index = None      # (count, unit-normalized projected rows)
+        self.partitions = None     # Partitions built by build_partitions()
+        self.index_config = None   # search strategy chosen by autotune()
     
-    def __init__(self):
-        self.documents = []
-        self.vectors = []
-        self.metadata = []
+    @classmethod
+    def from_arrays(cls, documents, categories, matrix, dtype=None):
+        """Wrap an existing (n, dims) matrix without copying it (unless dtype converts it)"""
+        matrix = np.asarray(matrix)
+        if dtype is None:
+            dtype = matrix.dtype if matrix.dtype in (np.float16, np.float32) else np.float32
+        db = cls(dtype=dtype)
+        matrix = np.asarray(matrix, dtype=db.dtype)
+        db.documents = documents if isinstance(documents, TextColumn) else TextColumn(documents)
+        db.categories = categories if isinstance(categories, CategoryColumn) else CategoryColumn(categories)
+        if len(matrix) == 0:
+            # Keep storage unset so the first add picks the vector width
+            return db
+        # Storage is exactly full, so the first add copies into writable capacity
+        db.storage = matrix
+        db.norm_storage = row_norms(matrix)
+        db.snapshot = Snapshot(matrix, db.norm_storage, len(matrix))
+        return db
     
     def add_document(self, text, category):
         """Add a document to the database"""
+        # Embed outside the lock; only the row copy is serialized
         vector = get_embedding(text)
-        self.documents.append(text)
-        self.vectors.append(vector)
-        self.metadata.append({'category': category})
+        self.add_vectors([text], [vector], [category])
     
-    def search(self, query, top_k=3, min_similarity=0.2):
-        """Search for most similar documents with configurable threshold"""
-        query_vector = get_embedding(query)
+    def add_documents(self, texts, categories, pool=None):
+        """Embed a batch of documents (optionally on an EmbeddingPool) and add them"""
+        if pool is not None:
+            vectors = pool.encode(texts)
+        else:
+            vectors = get_embedding_model().encode(list(texts), convert_to_numpy=True)
+        self.add_vectors(texts, vectors, categories)
+    
+    def add_vectors(self, texts, vectors, categories):
+        """Add documents with precomputed embeddings (no model call)"""
+        # Norms come from the stored precision so cosine scores stay consistent
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=self.dtype))
+        norms = row_norms(vectors)
         
-        similarities = []
-        for i, doc_vector in enumerate(self.vectors):
-            sim = cosine_similarity(query_vector, doc_vector)
-            # Only include results above threshold
-            if sim >= min_similarity:
-                similarities.append((sim, i))
+        with self.write_lock:
+            count = self.snapshot.count
+            needed = count + len(vectors)
+            
+            if self.storage is None:
+                self.storage = np.empty((max(self.initial_capacity, needed), vectors.shape[1]), dtype=self.dtype)
+                self.norm_storage = np.empty(len(self.storage), dtype=np.float32)
+            elif vectors.shape[1] != self.storage.shape[1]:
+                raise ValueError(f"Expected {self.storage.shape[1]}-dim vectors, got {vectors.shape[1]}")
+            
+            if needed > len(self.storage):
+                # Grow into fresh arrays; readers keep their views of the old ones
+                capacity = max(needed, 2 * len(self.storage))
+                storage = np.empty((capacity, self.storage.shape[1]), dtype=self.dtype)
+                norm_storage = np.empty(capacity, dtype=np.float32)
+                storage[:count] = self.storage[:count]
+                norm_storage[:count] = self.norm_storage[:count]
+                self.storage, self.norm_storage = storage, norm_storage
+            
+            # Rows past the published count are invisible until the snapshot swap
+            self.storage[count:needed] = vectors
+            self.norm_storage[count:needed] = norms
+            self.documents.extend(texts)
+            self.categories.extend(categories)
+            self.snapshot = Snapshot(self.storage[:needed], self.norm_storage[:needed], needed)
+    
+    def compact(self):
+        """Shrink storage to the published rows; the bulk copy runs outside the lock"""
+        snapshot = self.snapshot
+        matrix = snapshot.matrix.copy()
+        norms = snapshot.norms.copy()
+        
+        with self.write_lock:
+            current = self.snapshot
+            if current.count > snapshot.count:
+                # Pick up rows appended while we were copying
+                matrix = np.concatenate([matrix, current.matrix[snapshot.count:]])
+                norms = np.concatenate([norms, current.norms[snapshot.count:]])
+            if current.count:
+                self.storage, self.norm_storage = matrix, norms
+            self.snapshot = Snapshot(matrix, norms, current.count)
+    
+    def import_bundle(self, vectors_path, sidecar_path, model_name=EMBEDDING_MODEL_NAME, batch_size=1000):
+        """Stream an embedding bundle (see embedding_io) into the database"""
+        from embedding_io import read_bundle
+        
+        added = 0
+        for ids, texts, metadatas, vectors in read_bundle(vectors_path, sidecar_path,
+                                                          expected_model=model_name,
+                                                          batch_size=batch_size):
+            self.add_vectors(texts, vectors, [m.get('category', '') for m in metadatas])
+            added += len(ids)
+        return added
+    
+    def export_bundle(self, vectors_path, sidecar_path, model_name=EMBEDDING_MODEL_NAME, batch_size=1000):
+        """Write every document and vector as an embedding bundle"""
+        from embedding_io import BundleError, BundleWriter
         
-        # Sort by similarity (highest first)
-        similarities.sort(reverse=True)
+        matrix = self.snapshot.matrix
+        if len(matrix) == 0:
+            raise BundleError("Nothing to export: the database is empty (its vector dimensions are unknown)")
+        with BundleWriter(vectors_path, sidecar_path, model_name, matrix.shape[1], len(matrix)) as writer:
+            for start in range(0, len(matrix), batch_size):
+                stop = min(start + batch_size, len(matrix))
+                writer.write_batch(
+                    [str(i) for i in range(start, stop)],
+                    self.documents[start:stop],
+                    [{'category': category} for category in self.categories[start:stop]],
+                    matrix[start:stop]
+                )
+    
+    def get_matrix(self):
+        """All published document vectors as one (n, dims) matrix in the storage dtype"""
+        return self.snapshot.matrix
+    
+    def get_norms(self):
+        """Cached L2 norm of every published vector"""
+        return self.snapshot.norms
+    
+    def memory_usage(self):
+        """Bytes allocated by each part of the database, plus the total"""
+        partitions = self.partitions
+        usage = {
+            'vectors': 0 if self.storage is None else self.storage.nbytes,
+            'norms': 0 if self.norm_storage is None else self.norm_storage.nbytes,
+            **self.documents.nbytes(),
+            **self.categories.nbytes(),
+            'binary_index': 0 if self.binary_index is None else self.binary_index[1].nbytes,
+            'pca_index': 0 if self.pca_index is None else self.pca_index[1].nbytes,
+            'partitions': 0 if partitions is None else sum(array.nbytes for array in partitions[1:])
+        }
+        usage['total'] = sum(usage.values())
+        return usage
+    
+    def blas_limit(self, threads=None):
+        """BLAS thread cap for one search: the per-call value, else search_threads"""
+        return blas_threads(threads if threads is not None else self.search_threads)
+    
+    def score_rows(self, query_vector, rows=None, snapshot=None):
+        """Exact cosine similarity of the query against all rows, or just `rows`"""
+        snapshot = snapshot or self.snapshot
+        if rows is None:
+            return one_to_many(query_vector, snapshot.matrix, norms=snapshot.norms)
+        return one_to_many(query_vector, snapshot.matrix[rows], norms=snapshot.norms[rows])
+    
+    def format_results(self, scores, rows, top_k, min_similarity):
+        """Threshold, sort and decode the best rows into result dicts"""
+        keep = scores >= min_similarity
+        scores, rows = scores[keep], rows[keep]
+        order = np.argsort(-scores, kind='stable')[:top_k]
         
         results = []
-        for sim, idx in similarities[:top_k]:
+        for i in order:
+            idx = rows[i]
             results.append({
                 'document': self.documents[idx],
-                'similarity': sim,
-                'category': self.metadata[idx]['category']
+                'similarity': float(scores[i]),
+                'category': self.categories[idx]
             })
-        
         return results
+    
+    def get_binary_codes(self, snapshot=None):
+        """Packed sign bits for a snapshot, extending the published index incrementally"""
+        snapshot = snapshot or self.snapshot
+        index = self.binary_index
+        if index is None:
+            index = (snapshot.count, pack_sign_bits(snapshot.matrix))
+            self.binary_index = index
+        elif index[0] < snapshot.count:
+            new_codes = pack_sign_bits(snapshot.matrix[index[0]:])
+            index = (snapshot.count, np.concatenate([index[1], new_codes]))
+            self.binary_index = index
+        # Rows are append-only, so a newer index is valid for an older snapshot
+        return index[1][:snapshot.count]
+    
+    def build_binary_index(self):
+        """Build the packed sign-bit index used by search_binary()"""
+        return self.get_binary_codes()
+    
+    def fit_pca(self, n_components=64):
+        """Fit a PCA projection on the stored vectors for reduced-dimension scans"""
+        matrix = as_compute_array(self.snapshot.matrix)
+        mean = matrix.mean(axis=0)
+        # Rows of vt are the principal directions, strongest first
+        _, _, vt = np.linalg.svd(matrix - mean, full_matrices=False)
+        self.pca = (mean, vt[:n_components].astype(np.float32))
+        self.pca_index = None
+        return self.pca[1].shape[0]
+    
+    def project(self, vectors, pca=None):
+        """Project vectors into the fitted PCA space, unit-normalized for cosine"""
+        mean, components = pca or self.pca
+        reduced = (np.asarray(vectors, dtype=np.float32) - mean) @ components.T
+        norms = np.linalg.norm(reduced, axis=-1, keepdims=True)
+        return reduced / np.where(norms == 0, 1, norms)
+    
+    def get_pca_rows(self, snapshot, pca):
+        """Projected rows for a snapshot, extending the published index incrementally"""
+        index = self.pca_index
+        if index is None or index[2] is not pca:
+            index = (snapshot.count, self.project(snapshot.matrix, pca), pca)
+            self.pca_index = index
+        elif index[0] < snapshot.count:
+            new_rows = self.project(snapshot.matrix[index[0]:], pca)
+            index = (snapshot.count, np.concatenate([index[1], new_rows]), pca)
+            self.pca_index = index
+        return index[1][:snapshot.count]
+    
+    def rank_pca(self, query_vector, top_k=3, oversample=4, snapshot=None):
+        """Scan the reduced matrix, then re-rank an oversampled shortlist in full dimensions"""
+        snapshot = snapshot or self.snapshot
+        pca = self.pca
+        
+        approx = self.get_pca_rows(snapshot, pca) @ self.project(query_vector, pca)
+        n_candidates = min(top_k * oversample, len(approx))
+        if n_candidates < len(approx):
+            shortlist = np.argpartition(-approx, n_candidates)[:n_candidates]
+        else:
+            shortlist = np.arange(len(approx))
+        
+        scores = self.score_rows(query_vector, shortlist, snapshot)
+        order = np.argsort(-scores, kind='stable')[:top_k]
+        return [(float(scores[i]), shortlist[i]) for i in order]
+    
+    def search_pca(self, query, top_k=3, min_similarity=0.2, oversample=4, threads=None):
+        """Search in PCA space with full-dimension re-rank (call fit_pca() first)"""
+        snapshot = self.snapshot
+        if snapshot.count == 0:
+            return []
+        if self.pca is None:
+            raise ValueError("fit_pca() must be called before search_pca()")
+        
+        query_vector = get_embedding(query)
+        with self.blas_limit(threads):
+            ranked = self.rank_pca(query_vector, top_k, oversample, snapshot)
+        scores = np.array([sim for sim, _ in ranked], dtype=np.float32)
+        rows = np.array([idx for _, idx in ranked], dtype=np.intp)
+        return self.format_results(scores, rows, top_k, min_similarity)
+    
+    def evaluate_pca(self, queries, dims=(32, 64, 128), top_k=3, oversample=4):
+        """
+        Report recall@top_k and per-query latency of PCA search for each target dimension.
+        
+        Exact brute-force cosine over the full vectors is the ground truth. The
+        last fitted projection is left in place.
+        """
+        query_vectors = [get_embedding(q) for q in queries]
+        snapshot = self.snapshot
+        
+        start = time.perf_counter()
+        truth_ids, _ = top_k_search(query_vectors, snapshot.matrix, top_k, norms=snapshot.norms)
+        truth = [set(ids) for ids in truth_ids]
+        exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        
+        report = []
+        for n_components in dims:
+            actual_dims = self.fit_pca(n_components)
+            self.get_pca_rows(snapshot, self.pca)
+            
+            start = time.perf_counter()
+            found = [self.rank_pca(qv, top_k, oversample, snapshot) for qv in query_vectors]
+            latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+            
+            hits = sum(len(truth_ids & {idx for _, idx in ranked})
+                       for truth_ids, ranked in zip(truth, found))
+            report.append({
+                'dims': actual_dims,
+                'recall': hits / sum(len(t) for t in truth),
+                'latency_ms': latency_ms,
+                'exact_latency_ms': exact_ms
+            })
+        return report
+    
+    def build_partitions(self, n_partitions=None, iterations=8, seed=0):
+        """
+        Cluster the published rows with spherical k-means for pruned range search.
+        
+        Each partition keeps the mean of its unit rows and a radius (the
+        farthest member from that mean), so centroid . query + radius bounds
+        the best cosine any member can reach. Rows added later are scanned
+        exhaustively until the next rebuild.
+        """
+        snapshot = self.snapshot
+        if snapshot.count == 0:
+            return 0
+        n_partitions = min(snapshot.count, n_partitions or max(1, int(np.sqrt(snapshot.count))))
+        vectors = unit_rows(snapshot.matrix, snapshot.norms)
+        
+        rng = np.random.default_rng(seed)
+        centroids = vectors[rng.choice(snapshot.count, n_partitions, replace=False)]
+        for _ in range(iterations):
+            means, _, _ = partition_means(vectors, nearest_centroids(vectors, centroids), n_partitions)
+            lengths = np.linalg.norm(means, axis=1, keepdims=True)
+            # Empty partitions keep their old centroid
+            centroids = np.where(lengths > 0, means / np.where(lengths == 0, 1, lengths), centroids)
+        
+        assignment = nearest_centroids(vectors, centroids)
+        means, order, offsets = partition_means(vectors, assignment, n_partitions)
+        distances = np.linalg.norm(vectors - means[assignment], axis=1)
+        radii = np.zeros(n_partitions, dtype=np.float32)
+        np.maximum.at(radii, assignment, distances)
+        
+        self.partitions = Partitions(snapshot.count, means, radii + 1e-5, order,
+                                     offsets, np.ascontiguousarray(vectors[order], dtype=self.dtype))
+        return n_partitions
+    
+    def range_rows(self, query_vector, min_similarity, max_results=None, snapshot=None):
+        """
+        Rows scoring >= min_similarity as (scores, rows, rows_scanned).
+        
+        Partitions are visited best bound first; the scan stops at the first
+        partition whose bound is below the threshold, or below the weakest of
+        max_results matches already found.
+        """
+        snapshot = snapshot or self.snapshot
+        partitions = self.partitions
+        if partitions is None or partitions.count > snapshot.count:
+            scores = self.score_rows(query_vector, snapshot=snapshot)
+            keep = np.flatnonzero(scores >= min_similarity)
+            return scores[keep], keep, snapshot.count
+        
+        query_unit = unit_vector(query_vector)
+        if query_unit is None:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.intp), 0
+        found_scores, found_rows = [], []
+        
+        # Rows appended since the build are not partitioned yet
+        scanned = snapshot.count - partitions.count
+        if scanned:
+            tail = np.arange(partitions.count, snapshot.count)
+            scores = self.score_rows(query_vector, tail, snapshot)
+            keep = scores >= min_similarity
+            found_scores.append(scores[keep])
+            found_rows.append(tail[keep])
+        
+        floor = min_similarity
+        bounds = partitions.centroids @ query_unit + partitions.radii
+        for p in np.argsort(-bounds, kind='stable'):
+            if bounds[p] < floor:
+                break
+            start, stop = partitions.offsets[p], partitions.offsets[p + 1]
+            scores = one_to_many(query_unit, partitions.vectors[start:stop], metric="dot")
+            keep = scores >= min_similarity
+            found_scores.append(scores[keep])
+            found_rows.append(partitions.rows[start:stop][keep])
+            scanned += stop - start
+            
+            if max_results and keep.any():
+                all_scores = np.concatenate(found_scores)
+                if len(all_scores) >= max_results:
+                    floor = max(floor, np.partition(all_scores, -max_results)[-max_results])
+        
+        if not found_scores:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.intp), scanned
+        return np.concatenate(found_scores), np.concatenate(found_rows), scanned
+    
+    def rank_ivf(self, query_vector, top_k=3, nprobe=8, snapshot=None):
+        """
+        Exact cosine inside the nprobe partitions whose centroids best match the query.
+        
+        Rows appended since build_partitions() are always scored. Returns
+        (scores, rows) for the best top_k, best first.
+        """
+        snapshot = snapshot or self.snapshot
+        partitions = self.partitions
+        query_unit = unit_vector(query_vector)
+        if partitions is None or partitions.count > snapshot.count or query_unit is None:
+            scores = self.score_rows(query_vector, snapshot=snapshot)
+            rows = np.arange(len(scores))
+        else:
+            centroid_scores = partitions.centroids @ query_unit
+            nprobe = min(nprobe, len(centroid_scores))
+            probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+            positions = np.concatenate([np.arange(partitions.offsets[p], partitions.offsets[p + 1])
+                                        for p in probe])
+            scores = one_to_many(query_unit, partitions.vectors[positions], metric="dot")
+            rows = partitions.rows[positions]
+            if snapshot.count > partitions.count:
+                tail = np.arange(partitions.count, snapshot.count)
+                scores = np.concatenate([scores, self.score_rows(query_vector, tail, snapshot)])
+                rows = np.concatenate([rows, tail])
+        
+        if top_k < len(scores):
+            best = np.argpartition(-scores, top_k - 1)[:top_k]
+            scores, rows = scores[best], rows[best]
+        order = np.argsort(-scores, kind='stable')
+        return scores[order], rows[order]
+    
+    def autotune(self, queries=None, target_recall=0.95, top_k=10, n_queries=50,
+                 brute_force_limit=20000, seed=0):
+        """
+        Choose brute force or the partitioned (IVF) index and tune nprobe.
+        
+        Exact search is the ground truth. Without explicit query strings, a
+        random sample of stored rows is held out as queries (each row is
+        dropped from its own results). Corpora up to brute_force_limit stay
+        exact; larger ones get partitions and the smallest nprobe whose
+        recall@top_k meets target_recall, if that beats brute force on
+        latency. The choice lands in index_config, which search() follows
+        and save() persists. Returns None, leaving index_config alone, when
+        there is nothing to measure (an empty database or no queries).
+        """
+        snapshot = self.snapshot
+        # A held-out row needs at least one other row to find
+        if snapshot.count < (2 if queries is None else 1) or (queries is not None and len(queries) == 0):
+            return None
+        if queries is None:
+            rng = np.random.default_rng(seed)
+            held_out = rng.choice(snapshot.count, min(n_queries, snapshot.count), replace=False)
+            query_vectors = snapshot.matrix[held_out]
+        else:
+            held_out = None
+            query_vectors = np.array([get_embedding(q) for q in queries], dtype=np.float32)
+        extra = 0 if held_out is None else 1
+        top_k = max(1, min(top_k, snapshot.count - extra))
+        
+        def keep(i, rows):
+            return [r for r in rows if held_out is None or r != held_out[i]][:top_k]
+        
+        def measure(rank):
+            start = time.perf_counter()
+            found = [rank(qv) for qv in query_vectors]
+            latency_ms = (time.perf_counter() - start) * 1000 / len(query_vectors)
+            hits = sum(len(truth[i] & set(keep(i, rows.tolist()))) for i, rows in enumerate(found))
+            total = sum(len(t) for t in truth)
+            return (hits / total if total else 1.0), latency_ms
+        
+        truth_ids, _ = top_k_search(query_vectors, snapshot.matrix, top_k + extra, norms=snapshot.norms)
+        truth = [set(keep(i, rows)) for i, rows in enumerate(truth_ids.tolist())]
+        
+        def rank_exact(qv):
+            scores = self.score_rows(qv, snapshot=snapshot)
+            k = min(top_k + extra, len(scores))
+            return np.argpartition(-scores, k - 1)[:k]
+        
+        _, exact_ms = measure(rank_exact)
+        config = {
+            'strategy': 'brute_force',
+            'top_k': top_k,
+            'target_recall': target_recall,
+            'recall': 1.0,
+            'latency_ms': exact_ms,
+            'exact_latency_ms': exact_ms,
+            'trials': []
+        }
+        
+        if snapshot.count > brute_force_limit:
+            if self.partitions is None or self.partitions.count != snapshot.count:
+                self.build_partitions()
+            n_partitions = len(self.partitions.centroids)
+            nprobe = 1
+            while True:
+                recall, latency_ms = measure(lambda qv: self.rank_ivf(qv, top_k + extra, nprobe, snapshot)[1])
+                config['trials'].append({'nprobe': nprobe, 'recall': recall, 'latency_ms': latency_ms})
+                if recall >= target_recall or nprobe >= n_partitions:
+                    break
+                nprobe = min(nprobe * 2, n_partitions)
+            if recall >= target_recall and latency_ms < exact_ms:
+                config.update(strategy='ivf', nprobe=nprobe, n_partitions=n_partitions,
+                              recall=recall, latency_ms=latency_ms)
+        
+        self.index_config = config
+        return config
+    
+    def save(self, path):
+        """Save documents, vectors, PCA projection, partitions and tuned config to one .npz file"""
+        snapshot = self.snapshot
+        text_buffer, text_offsets = self.documents.compact_arrays()
+        arrays = {
+            'text_buffer': text_buffer[:text_offsets[snapshot.count]],
+            'text_offsets': text_offsets[:snapshot.count + 1],
+            'category_values': np.array(self.categories.values, dtype=str),
+            'category_codes': self.categories.codes[:snapshot.count],
+            'vectors': snapshot.matrix
+        }
+        if self.pca is not None:
+            arrays['pca_mean'], arrays['pca_components'] = self.pca
+        partitions = self.partitions
+        if partitions is not None and partitions.count <= snapshot.count:
+            arrays['partition_count'] = np.array(partitions.count)
+            arrays['partition_centroids'] = partitions.centroids
+            arrays['partition_radii'] = partitions.radii
+            arrays['partition_rows'] = partitions.rows
+            arrays['partition_offsets'] = partitions.offsets
+        if self.index_config is not None:
+            arrays['index_config'] = np.array(json.dumps(self.index_config))
+        np.savez(path, **arrays)
+    
+    @classmethod
+    def load(cls, path, dtype=None):
+        """Load a database written by save() (dtype=None keeps the saved vector dtype)"""
+        with np.load(path, allow_pickle=False) as data:
+            if 'text_buffer' in data:
+                documents = TextColumn.from_buffers(data['text_buffer'], data['text_offsets'])
+                categories = CategoryColumn.from_codes(data['category_values'].tolist(), data['category_codes'])
+            else:
+                # Files written before the columnar layout
+                documents, categories = data['documents'].tolist(), data['categories'].tolist()
+            db = cls.from_arrays(documents, categories, data['vectors'], dtype)
+            if 'pca_components' in data:
+                db.pca = (data['pca_mean'], data['pca_components'])
+            if 'partition_rows' in data:
+                # Unit rows are cheap to rebuild, so only the layout is stored
+                count = int(data['partition_count'])
+                rows = data['partition_rows']
+                vectors = unit_rows(db.snapshot.matrix[:count], db.snapshot.norms[:count])[rows].astype(db.dtype)
+                db.partitions = Partitions(count, data['partition_centroids'], data['partition_radii'],
+                                           rows, data['partition_offsets'], vectors)
+            if 'index_config' in data:
+                db.index_config = json.loads(str(data['index_config']))
+        return db
+    
+    def save_sqlite(self, db_path, model_name=EMBEDDING_MODEL_NAME):
+        """
+        Write documents and embeddings into lab 1's handbook schema.
+        
+        Documents are policies rows (title = category); a row with the same
+        title and content is reused, anything else is appended, so existing
+        handbook policies are never overwritten. Vectors go into
+        policy_vectors keyed by policy id; saving again replaces everything
+        previously saved under model_name.
+        """
+        snapshot = self.snapshot
+        conn = sqlite3.connect(db_path)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS policies (
+                id INTEGER PRIMARY KEY,
+                title TEXT,
+                content TEXT
+            )
+        ''')
+        create_vector_table(conn)
+        
+        existing = {(title, content): policy_id
+                    for policy_id, title, content in conn.execute('SELECT id, title, content FROM policies')}
+        next_id = max(existing.values(), default=0) + 1
+        policy_ids, new_rows = [], []
+        for category, document in zip(self.categories, self.documents):
+            policy_id = existing.get((category, document))
+            if policy_id is None:
+                policy_id = existing[(category, document)] = next_id
+                next_id += 1
+                new_rows.append((policy_id, category, document))
+            policy_ids.append(policy_id)
+        
+        with conn:
+            conn.execute('DELETE FROM policy_vectors WHERE model = ?', (model_name,))
+            conn.executemany('INSERT INTO policies (id, title, content) VALUES (?, ?, ?)', new_rows)
+        store_embeddings(conn, policy_ids, snapshot.matrix, model_name)
+        conn.close()
+    
+    @classmethod
+    def load_sqlite(cls, db_path, model_name=EMBEDDING_MODEL_NAME, dtype=None):
+        """Build a database from the policies and policy_vectors tables (no model calls)"""
+        conn = sqlite3.connect(db_path)
+        policy_ids, matrix = load_vector_matrix(conn, model_name)
+        policies = {policy_id: (title, content)
+                    for policy_id, title, content in conn.execute('SELECT id, title, content FROM policies')}
+        conn.close()
+        
+        if not len(policy_ids):
+            return cls(dtype=dtype or np.float32)
+        # The frombuffer matrix becomes the storage as-is
+        rows = [policies[int(policy_id)] for policy_id in policy_ids]
+        return cls.from_arrays([row[1] for row in rows], [row[0] for row in rows], matrix, dtype)
+    
+    def search(self, query, top_k=3, min_similarity=0.2, threads=None):
+        """Search for most similar documents with configurable threshold"""
+        if self.snapshot.count == 0:
+            return []
+        return self.search_vector(get_embedding(query), top_k, min_similarity, threads)
+    
+    def search_vector(self, query_vector, top_k=3, min_similarity=0.2, threads=None):
+        """search() for an already-embedded query"""
+        snapshot = self.snapshot
+        if snapshot.count == 0:
+            return []
+        
+        with self.blas_limit(threads):
+            config = self.index_config
+            if config is not None and config['strategy'] == 'ivf' and self.partitions is not None:
+                scores, rows = self.rank_ivf(query_vector, top_k, config['nprobe'], snapshot)
+                return self.format_results(scores, rows, top_k, min_similarity)
+            
+            # Score every document in one vectorized pass, then keep those above threshold
+            scores = self.score_rows(query_vector, snapshot=snapshot)
+        return self.format_results(scores, np.arange(len(scores)), top_k, min_similarity)
+    
+    def search_range(self, query, min_similarity, max_results=None, threads=None):
+        """
+        Every document with similarity >= min_similarity, best first.
+        
+        No top_k guess needed. Call build_partitions() first to skip
+        partitions that cannot reach the threshold; max_results=1 then
+        answers "is anything relevant?" after scanning very few rows.
+        """
+        snapshot = self.snapshot
+        if snapshot.count == 0:
+            return []
+        query_vector = get_embedding(query)
+        with self.blas_limit(threads):
+            scores, rows, _ = self.range_rows(query_vector, min_similarity, max_results, snapshot)
+        return self.format_results(scores, rows, max_results, min_similarity)
+    
+    def search_binary(self, query, top_k=3, min_similarity=0.2, candidates=50, threads=None):
+        """
+        Two-stage search: Hamming prefilter over sign bits, then exact cosine.
+        
+        Only the `candidates` rows closest in Hamming distance are re-scored
+        with full cosine similarity, so the first stage touches 48 bytes per
+        document instead of 1536.
+        """
+        snapshot = self.snapshot
+        if snapshot.count == 0:
+            return []
+        
+        query_vector = get_embedding(query)
+        distances = hamming_distances(self.get_binary_codes(snapshot), pack_sign_bits(query_vector))
+        
+        if candidates < len(distances):
+            shortlist = np.argpartition(distances, candidates)[:candidates]
+        else:
+            shortlist = np.arange(len(distances))
+        
+        with self.blas_limit(threads):
+            scores = self.score_rows(query_vector, shortlist, snapshot)
+        return self.format_results(scores, shortlist, top_k, min_similarity)
 
-def main():
-    """Demonstrate semantic similarity search"""
+def main(profile_path=None):
+    """Demonstrate semantic similarity search (profile_path writes a memory profile report)"""
+    
+    profiler = Profiler().start() if profile_path else None
     
     print("=" * 70)
     print("🔍 Lab 3: Similarity Search - Finding Meaning with Math")
@@ -87,6 +895,8 @@ def main():
     
     # Initialize vector database
     db = VectorDatabase()
+    with profile_stage(profiler, 'load'):
+        get_embedding_model()
     
     # Add Tia's handbook policies
     policies = [
@@ -101,9 +911,15 @@ def main():
     print("📚 Building Vector Database:")
     print("-" * 50)
     
+    stage = start_stage(profiler, 'add')
     for policy, category in policies:
         db.add_document(policy, category)
         print(f"✅ Added: {category:12} policy to vector database")
+    stage.close()
+    
+    usage = db.memory_usage()
+    print(f"\n💾 Memory: {usage['total']:,} bytes total ({usage['vectors']:,} vectors, "
+          f"{usage['text_buffer']:,} text, {usage['category_codes']:,} category codes)")
     
     # Test queries
     test_queries = [
@@ -119,6 +935,7 @@ def main():
     print("🎯 SEMANTIC SEARCH RESULTS")
     print("=" * 70)
     
+    stage = start_stage(profiler, 'query')
     for query in test_queries:
         print(f"\n❓ Query: '{query}'")
         print("-" * 50)
@@ -134,6 +951,13 @@ def main():
                 print(f"     '{result['document'][:60]}...'")
         else:
             print("❌ No matches found above threshold")
+    stage.close()
+    
+    if profiler is not None:
+        profiler.account('vector_database', db.memory_usage())
+        profiler.write(profile_path)
+        profiler.print_summary()
+        print(f"💾 Memory profile written to {profile_path}")
     
     # NEW: Demonstrate the Florida example - context matters!
     print("\n" + "=" * 70)
@@ -180,6 +1004,37 @@ def main():
     
     print("\n💡 Higher threshold = fewer but more confident results!")
     
+    # Binary quantization: a tiny first-stage filter in front of exact cosine
+    print("\n" + "=" * 70)
+    print("⚡ BINARY QUANTIZATION: 1 BIT PER DIMENSION")
+    print("=" * 70)
+    
+    codes = db.build_binary_index()
+    print(f"\n📦 Full vectors: {db.get_matrix().nbytes} bytes, sign bits: {codes.nbytes} bytes")
+    binary_results = db.search_binary(test_query, top_k=1, min_similarity=0.0, candidates=3)
+    exact_results = db.search(test_query, top_k=1, min_similarity=0.0)
+    print(f"🔍 '{test_query}'")
+    print(f"   Hamming prefilter + cosine re-rank → {binary_results[0]['category']}")
+    print(f"   Exact cosine over everything      → {exact_results[0]['category']}")
+    
+    # Range search: every match above a threshold, no top_k guess
+    print("\n" + "=" * 70)
+    print("🎯 RANGE SEARCH: EVERYTHING ABOVE A THRESHOLD")
+    print("=" * 70)
+    
+    db.build_partitions(n_partitions=3)
+    query_vector = get_embedding(test_query)
+    for threshold in [0.5, 0.3]:
+        results = db.search_range(test_query, min_similarity=threshold)
+        _, _, scanned = db.range_rows(query_vector, threshold)
+        print(f"\n📌 similarity >= {threshold:.1f}: {len(results)} match(es), scanned {scanned}/{len(db.documents)} documents")
+        for r in results:
+            print(f"   • {r['category']:12} ({r['similarity']:.1%})")
+    
+    config = db.autotune(top_k=3)
+    print(f"\n🧭 Auto-tuned index for {len(db.documents)} documents: {config['strategy']} "
+          f"(recall@{config['top_k']} {config['recall']:.0%}, {config['latency_ms']:.2f} ms/query)")
+    
     # Interactive demo
     input("\n➡️  Press Enter to try the interactive similarity search...")
     
@@ -266,4 +1121,7 @@ def main():
     print("✅ Lab 3 Complete! Run lab4_vector_database.py for the complete system.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Lab 3: Similarity Search")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="Write a per-stage tracemalloc/RSS memory report to PATH (JSON)")
+    main(parser.parse_args().profile)
\ No newline at end of file
@@ -5,30 +5,53 @@ Real documents, real embeddings, real search!
 """
 
 import os
+import re
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+from similarity import rowwise, top_k as top_k_search
+from profiling import Profiler, deep_sizeof, profile_stage, start_stage
 import chromadb
-from chromadb.utils import embedding_functions
+from chromadb.errors import NotFoundError
 from datetime import datetime
 
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+EMBEDDING_DIMENSIONS = 384
+COLLECTION_NAME = "company_docs"
+# Bump whenever chunk ids, chunk metadata or chunking rules change shape
+SCHEMA_VERSION = 1
+# Stay under Chroma's per-call row limit (get_max_batch_size(), 5461 by default)
+ADD_BATCH_SIZE = 5000
+
+# Global model instance to avoid reloading
+model = None
+# One Chroma embedding function shared by every collection (see get_embedding_function)
+embedding_function = None
+
+def get_embedding_model():
+    """Get or initialize the sentence-transformers model (used for its tokenizer)"""
+    global model
+    if model is None:
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+    return model
+
 def load_documents_from_folder(folder_path):
-    """Load all markdown documents from a folder"""
+    """Load all markdown documents under a folder, including subfolders"""
     documents = []
     
     if not os.path.exists(folder_path):
         print(f"❌ Folder {folder_path} not found!")
         return documents
     
-    for filename in os.listdir(folder_path):
-        if filename.endswith('.md'):
-            file_path = os.path.join(folder_path, filename)
-            with open(file_path, 'r') as f:
-                content = f.read()
-                # Remove the .md extension for display
-                doc_name = filename.replace('.md', '').replace('_', ' ').title()
-                documents.append({
-                    'content': content,
-                    'source': filename,
-                    'title': doc_name
-                })
+    # Sources are paths relative to the folder, the same keys watch mode uses
+    for relative_path in sorted(scan_markdown_files(folder_path)):
+        documents.append(read_document(folder_path, relative_path))
     
     return documents
 
@@ -153,40 +176,496 @@ def smart_chunk_document(text, source, chunk_size=500, overlap_sentences=2):
     
     return chunks
 
-def setup_chromadb():
-    """Initialize ChromaDB with sentence-transformers embedding"""
-    print("🔧 Initializing ChromaDB with real embeddings...")
+def count_tokens(texts, tokenizer):
+    """Count word-piece tokens per text, excluding the [CLS]/[SEP] special tokens"""
+    if not texts:
+        return []
+    encoded = tokenizer(list(texts), add_special_tokens=False, verbose=False)
+    return [len(ids) for ids in encoded['input_ids']]
+
+def split_oversized_sentence(sentence, tokenizer, max_tokens):
+    """Split a sentence that exceeds the token budget at word boundaries"""
+    words = sentence.split()
+    word_tokens = count_tokens(words, tokenizer)
     
-    # Use persistent storage
-    client = chromadb.PersistentClient(path="./chroma_db")
+    pieces = []
+    current_words = []
+    current_tokens = 0
+    for word, n_tokens in zip(words, word_tokens):
+        if current_tokens + n_tokens > max_tokens and current_words:
+            pieces.append((' '.join(current_words), current_tokens))
+            current_words = []
+            current_tokens = 0
+        current_words.append(word)
+        current_tokens += n_tokens
+    if current_words:
+        pieces.append((' '.join(current_words), current_tokens))
+    return pieces
+
+def token_chunk_document(text, source, max_tokens=None, overlap_tokens=32, tokenizer=None):
+    """
+    Token-aware chunking that packs whole sentences up to the model's token budget.
+    
+    Character-sized chunks are either silently truncated by the model (wasted work)
+    or far below its limit (more vectors than needed). Measuring with the model's
+    own tokenizer fills every chunk right up to what the model actually reads.
+    
+    Args:
+        text: Document text to chunk
+        source: Source document name
+        max_tokens: Token budget per chunk (default: model max_seq_length minus [CLS]/[SEP])
+        overlap_tokens: Maximum tokens of trailing sentences repeated in the next chunk
+        tokenizer: Tokenizer to measure with (default: the all-MiniLM-L6-v2 tokenizer)
+    """
+    if tokenizer is None or max_tokens is None:
+        embedding_model = get_embedding_model()
+        tokenizer = tokenizer or embedding_model.tokenizer
+        if max_tokens is None:
+            max_tokens = embedding_model.max_seq_length - 2
+    
+    # Sentences are the packing unit; paragraphs and headers never merge mid-sentence
+    sentences = []
+    for paragraph in split_into_paragraphs(text):
+        sentences.extend(split_into_sentences(paragraph))
+    
+    # WordPiece splits on whitespace first, so the token count of a space-joined
+    # chunk is exactly the sum of its sentences' counts
+    units = []
+    for sentence, n_tokens in zip(sentences, count_tokens(sentences, tokenizer)):
+        if n_tokens > max_tokens:
+            units.extend(split_oversized_sentence(sentence, tokenizer, max_tokens))
+        else:
+            units.append((sentence, n_tokens))
+    
+    chunks = []
+    current_chunk = []
+    current_tokens = 0
+    
+    for sentence, n_tokens in units:
+        if current_tokens + n_tokens > max_tokens and current_chunk:
+            chunks.append({
+                'text': ' '.join(s for s, _ in current_chunk),
+                'metadata': {
+                    'source': source,
+                    'chunk_id': len(chunks),
+                    'sentence_count': len(current_chunk),
+                    'token_count': current_tokens
+                }
+            })
+            
+            # Keep trailing sentences that fit in the overlap budget
+            overlap = []
+            overlap_size = 0
+            for unit in reversed(current_chunk):
+                if overlap_size + unit[1] > overlap_tokens:
+                    break
+                overlap.insert(0, unit)
+                overlap_size += unit[1]
+            # Never let the overlap push the next sentence over budget
+            while overlap and overlap_size + n_tokens > max_tokens:
+                overlap_size -= overlap.pop(0)[1]
+            current_chunk = overlap
+            current_tokens = overlap_size
+        
+        current_chunk.append((sentence, n_tokens))
+        current_tokens += n_tokens
+    
+    # Don't forget the last chunk
+    if current_chunk:
+        chunks.append({
+            'text': ' '.join(s for s, _ in current_chunk),
+            'metadata': {
+                'source': source,
+                'chunk_id': len(chunks),
+                'sentence_count': len(current_chunk),
+                'token_count': current_tokens
+            }
+        })
+    
+    for chunk in chunks:
+        chunk['metadata']['total_chunks'] = len(chunks)
+    
+    return chunks
+
+def normalize_chunk_text(text):
+    """Normalize chunk text for duplicate detection (whitespace and case)"""
+    # all-MiniLM-L6-v2 uses an uncased tokenizer, so case never changes the vector
+    return ' '.join(text.split()).lower()
+
+def embed_unique_texts(texts, batch_size=64, pool=None):
+    """
+    Embed each distinct text once and fan the vectors back out.
+    
+    Encodes in-process, or across worker processes when an EmbeddingPool is
+    given. Returns (embeddings, unique_count) where embeddings[i] belongs to texts[i].
+    """
+    unique_index = {}
+    unique_texts = []
+    positions = []
+    for text in texts:
+        key = hashlib.sha1(normalize_chunk_text(text).encode('utf-8')).digest()
+        if key not in unique_index:
+            unique_index[key] = len(unique_texts)
+            unique_texts.append(text)
+        positions.append(unique_index[key])
+    
+    if not unique_texts:
+        return [], 0
+    
+    if pool is not None:
+        unique_vectors = pool.encode(unique_texts)
+    else:
+        unique_vectors = get_embedding_model().encode(
+            unique_texts, batch_size=batch_size, convert_to_numpy=True
+        )
+    return unique_vectors[positions], len(unique_texts)
+
+def find_near_duplicates(embeddings, threshold=0.95, n_bands=20, rows_per_band=16, seed=42,
+                         batch_size=65536):
+    """
+    Find near-duplicate vectors with random-hyperplane LSH plus banding.
+    
+    Each vector gets n_bands * rows_per_band sign bits from random hyperplanes.
+    Vectors sharing any whole band land in the same bucket, and each one is
+    compared with its bucket's first member, so a bucket of m rows costs
+    m - 1 comparisons instead of all m * (m - 1) / 2 pairs.
+    With the defaults a pair at cosine 0.95 collides in some band ~98% of the
+    time, while unrelated (orthogonal) pairs collide ~0.03% of the time.
+    Candidates are confirmed with exact cosine >= threshold, batch_size pairs
+    at a time.
+    
+    Returns canonical, where canonical[i] is the lowest index of the
+    near-duplicate group containing row i (canonical[i] == i for originals).
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    n = len(embeddings)
+    rng = np.random.default_rng(seed)
+    planes = rng.standard_normal((n_bands * rows_per_band, embeddings.shape[1])).astype(np.float32)
+    signatures = embeddings @ planes.T > 0
+    
+    candidates = set()
+    for band in range(n_bands):
+        band_bits = np.packbits(signatures[:, band * rows_per_band:(band + 1) * rows_per_band], axis=1)
+        buckets = {}
+        for row, key in enumerate(map(bytes, band_bits)):
+            buckets.setdefault(key, []).append(row)
+        # Pair each member with its bucket's first member only (linear per bucket);
+        # duplicates of that representative are joined through it by union-find
+        for members in buckets.values():
+            for b in members[1:]:
+                candidates.add((members[0], b))
+    
+    # Union-find over confirmed pairs; the smallest index becomes canonical
+    parent = list(range(n))
+    
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    
+    pairs = np.array(sorted(candidates), dtype=np.intp).reshape(-1, 2)
+    for start in range(0, len(pairs), batch_size):
+        batch = pairs[start:start + batch_size]
+        similar = rowwise(embeddings[batch[:, 0]], embeddings[batch[:, 1]]) >= threshold
+        for a, b in batch[similar]:
+            root_a, root_b = find(a), find(b)
+            if root_a != root_b:
+                parent[max(root_a, root_b)] = min(root_a, root_b)
+    
+    return [find(i) for i in range(n)]
+
+def apply_near_duplicates(texts, ids, metadatas, embeddings, mode, threshold=0.95,
+                          collection=None, exclude_sources=()):
+    """
+    Drop ("drop") or tag ("link") near-duplicate chunk records.
+    
+    Rows are grouped with find_near_duplicates() and every row defers to its
+    group's first row. With a collection, each group's first row is also
+    checked against the chunks already stored there (except those of
+    exclude_sources, the documents being re-indexed). "link" records the
+    canonical chunk id as 'canonical_id' metadata.
+    Returns (texts, ids, metadatas, embeddings, duplicate_count).
+    """
+    canonical = find_near_duplicates(embeddings, threshold=threshold)
+    stored = [None] * len(ids)
+    if collection is not None and collection.count():
+        roots = [i for i, root in enumerate(canonical) if root == i]
+        where = {"source": {"$nin": list(exclude_sources)}} if exclude_sources else None
+        results = collection.query(query_embeddings=embeddings[roots], n_results=1, where=where,
+                                   include=['distances'])
+        for i, found, distances in zip(roots, results['ids'], results['distances']):
+            if found and 1 - distances[0] >= threshold:
+                stored[i] = found[0]
+    canonical_ids = [stored[root] or (ids[root] if root != i else None) for i, root in enumerate(canonical)]
+    duplicates = sum(canonical_id is not None for canonical_id in canonical_ids)
+    
+    if mode == "drop":
+        keep = [i for i, canonical_id in enumerate(canonical_ids) if canonical_id is None]
+        return ([texts[i] for i in keep], [ids[i] for i in keep], [metadatas[i] for i in keep],
+                embeddings[keep], duplicates)
+    for metadata, canonical_id in zip(metadatas, canonical_ids):
+        if canonical_id is not None:
+            metadata['canonical_id'] = canonical_id
+    return texts, ids, metadatas, embeddings, duplicates
+
+def corpus_fingerprint(folder_path, chunk_mode="characters"):
+    """Hash of every markdown file (subfolders included) plus the settings that shape the index"""
+    digest = hashlib.sha1(f"{EMBEDDING_MODEL_NAME}|{SCHEMA_VERSION}|{chunk_mode}".encode('utf-8'))
+    for relative_path in sorted(scan_markdown_files(folder_path)):
+        try:
+            with open(os.path.join(folder_path, relative_path), 'rb') as f:
+                digest.update(relative_path.encode('utf-8'))
+                digest.update(hashlib.sha1(f.read()).digest())
+        except FileNotFoundError:
+            continue  # removed since the scan
+    return digest.hexdigest()
+
+class SharedModelEmbeddingFunction(chromadb.EmbeddingFunction):
+    """
+    Chroma embedding function that encodes with get_embedding_model().
+    
+    Chroma and embed_unique_texts then share one copy of the model. It is
+    persisted under the same name and config as Chroma's own
+    SentenceTransformerEmbeddingFunction, so stores written by either open
+    with the other.
+    """
+    
+    def __init__(self):
+        pass
+    
+    def __call__(self, input):
+        vectors = get_embedding_model().encode(list(input), convert_to_numpy=True)
+        return [np.asarray(vector, dtype=np.float32) for vector in vectors]
+    
+    @staticmethod
+    def name():
+        return "sentence_transformer"
+    
+    def default_space(self):
+        return "cosine"
+    
+    def supported_spaces(self):
+        return ["cosine", "l2", "ip"]
     
-    # Delete existing collection for clean demo
+    def get_config(self):
+        return {
+            "model_name": EMBEDDING_MODEL_NAME,
+            "device": str(get_embedding_model().device),
+            "normalize_embeddings": False,
+            "kwargs": {}
+        }
+    
+    @staticmethod
+    def build_from_config(config):
+        if config.get("model_name", EMBEDDING_MODEL_NAME) != EMBEDDING_MODEL_NAME:
+            raise ValueError(f"Collection was embedded with {config['model_name']!r}, not {EMBEDDING_MODEL_NAME!r}")
+        return SharedModelEmbeddingFunction()
+
+def get_embedding_function():
+    """The all-MiniLM-L6-v2 (384 dimensions) embedding function shared by every collection"""
+    global embedding_function
+    if embedding_function is None:
+        embedding_function = SharedModelEmbeddingFunction()
+    return embedding_function
+
+def reset_collection(client, embedding_function):
+    """Delete any existing collection and create an empty one"""
     try:
-        client.delete_collection(name="company_docs")
-    except:
+        client.delete_collection(name=COLLECTION_NAME)
+    except NotFoundError:
         pass
     
-    # Create collection with sentence-transformers embedding
-    # This uses the all-MiniLM-L6-v2 model (384 dimensions)
-    sentence_transformer_ef = embedding_functions.SentenceTransformerEmbeddingFunction(
-        model_name="all-MiniLM-L6-v2"
+    return client.create_collection(
+        name=COLLECTION_NAME,
+        embedding_function=embedding_function,
+        metadata={
+            "hnsw:space": "cosine",
+            "embedding_model": EMBEDDING_MODEL_NAME,
+            "schema_version": SCHEMA_VERSION
+        }
     )
+
+def setup_chromadb(warm_start=False, store_path="./chroma_db"):
+    """
+    Initialize ChromaDB with sentence-transformers embedding
     
-    collection = client.create_collection(
-        name="company_docs",
-        embedding_function=sentence_transformer_ef,
-        metadata={"hnsw:space": "cosine"}
-    )
+    By default the collection is rebuilt for a clean demo. With warm_start the
+    persisted collection (and its HNSW index) is reopened, as long as it was
+    built with the same embedding model and schema version.
+    """
+    print("🔧 Initializing ChromaDB with real embeddings...")
+    
+    # Use persistent storage
+    client = chromadb.PersistentClient(path=store_path)
+    sentence_transformer_ef = get_embedding_function()
+    
+    if warm_start:
+        collection = client.get_or_create_collection(
+            name=COLLECTION_NAME,
+            embedding_function=sentence_transformer_ef,
+            metadata={
+                "hnsw:space": "cosine",
+                "embedding_model": EMBEDDING_MODEL_NAME,
+                "schema_version": SCHEMA_VERSION
+            }
+        )
+        stored = collection.metadata or {}
+        if (stored.get("embedding_model") != EMBEDDING_MODEL_NAME
+                or stored.get("schema_version") != SCHEMA_VERSION):
+            print(f"⚠️  Stored index was built with {stored.get('embedding_model')} "
+                  f"(schema v{stored.get('schema_version')}), rebuilding")
+            collection = reset_collection(client, sentence_transformer_ef)
+        else:
+            print(f"♻️  Reopened persisted collection with {collection.count()} chunks")
+    else:
+        # Delete existing collection for clean demo
+        collection = reset_collection(client, sentence_transformer_ef)
     
     print("✅ ChromaDB initialized with all-MiniLM-L6-v2 embeddings (384 dimensions)")
     return client, collection
 
-def load_and_chunk_documents(folder_path, collection):
-    """Load documents, chunk them, and add to ChromaDB"""
+def is_collection_current(collection, fingerprint):
+    """True when the persisted collection was built from exactly this corpus"""
+    stored = collection.metadata or {}
+    return collection.count() > 0 and stored.get("corpus_fingerprint") == fingerprint
+
+def mark_collection_current(collection, fingerprint):
+    """Record the corpus fingerprint so the next warm start can skip ingestion"""
+    # modify() replaces user metadata, so carry the other keys (e.g. tuned_*) over;
+    # the hnsw space lives in the collection config
+    metadata = {k: v for k, v in (collection.metadata or {}).items() if not k.startswith("hnsw:")}
+    metadata.update({
+        "embedding_model": EMBEDDING_MODEL_NAME,
+        "schema_version": SCHEMA_VERSION,
+        "corpus_fingerprint": fingerprint
+    })
+    collection.modify(metadata=metadata)
+
+def snapshot_store(store_path, archive_base, client=None):
+    """
+    Archive the persisted store directory so replicas can boot from it.
+    
+    Chroma flushes SQLite and HNSW files lazily, so the store must be closed
+    while it is copied: pass this process's client and it is closed first
+    (reopen afterwards). Any other client on the same path, in this or
+    another process, must be closed too; a shared system is only stopped
+    when its last client closes. Returns the path of the created .tar.gz.
+    """
+    if client is not None:
+        client.close()
+    archive_path = shutil.make_archive(archive_base, 'gztar', root_dir=store_path)
+    print(f"📦 Snapshot of {store_path} written to {archive_path}")
+    return archive_path
+
+def store_memory_usage(store_path, collection=None):
+    """
+    Byte breakdown of a persisted Chroma store.
+    
+    HNSW vector and link files (loaded into memory when the collection is
+    queried) are separated from the SQLite document/metadata database.
+    With a collection, also estimates the float32 vectors it holds in memory.
+    """
+    usage = {'sqlite': 0, 'hnsw_vectors': 0, 'hnsw_links': 0, 'other': 0}
+    for root, _, files in os.walk(store_path):
+        for name in files:
+            size = os.path.getsize(os.path.join(root, name))
+            if name.startswith('chroma.sqlite3'):
+                usage['sqlite'] += size
+            elif name == 'data_level0.bin':
+                usage['hnsw_vectors'] += size
+            elif name == 'link_lists.bin':
+                usage['hnsw_links'] += size
+            else:
+                usage['other'] += size
+    usage['total'] = sum(usage.values())
+    if collection is not None:
+        usage['chunks'] = collection.count()
+        usage['estimated_vector_bytes'] = usage['chunks'] * EMBEDDING_DIMENSIONS * 4
+    return usage
+
+def restore_store(archive_path, store_path):
+    """
+    Replace the store directory with the contents of a snapshot archive.
+    
+    The archive is unpacked into a temporary directory next to the store
+    and renamed into place, so a missing or corrupt archive leaves the
+    existing store untouched. The old store is removed only after the swap.
+    """
+    store_path = os.path.abspath(store_path)
+    parent = os.path.dirname(store_path)
+    os.makedirs(parent, exist_ok=True)
+    unpacked = tempfile.mkdtemp(prefix=os.path.basename(store_path) + '.restore-', dir=parent)
+    try:
+        shutil.unpack_archive(archive_path, unpacked)
+    except BaseException:
+        shutil.rmtree(unpacked, ignore_errors=True)
+        raise
+    
+    previous = None
+    if os.path.exists(store_path):
+        previous = tempfile.mkdtemp(prefix=os.path.basename(store_path) + '.old-', dir=parent)
+        os.rename(store_path, os.path.join(previous, 'store'))
+    os.rename(unpacked, store_path)
+    if previous is not None:
+        shutil.rmtree(previous)
+    print(f"📦 Restored {store_path} from {archive_path}")
+
+def chunk_document(doc, chunk_mode="characters"):
+    """Chunk one loaded document with the configured chunking mode"""
+    if chunk_mode == "tokens":
+        # Fill each chunk up to the model's max sequence length
+        return token_chunk_document(
+            doc['content'],
+            doc['source'],
+            overlap_tokens=32
+        )
+    # Chunk the document with sentence-based overlap
+    return smart_chunk_document(
+        doc['content'], 
+        doc['source'],
+        chunk_size=500,
+        overlap_sentences=2  # Overlap 2 complete sentences
+    )
+
+def chunk_records(doc, chunks):
+    """Chroma (texts, ids, metadatas) for a document's chunks; ids are '<source>_<chunk_id>'"""
+    texts, ids, metadatas = [], [], []
+    for chunk in chunks:
+        texts.append(chunk['text'])
+        ids.append(f"{doc['source']}_{chunk['metadata']['chunk_id']}")
+        metadatas.append({
+            'source': doc['source'],
+            'title': doc['title'],
+            'chunk_id': chunk['metadata']['chunk_id'],
+            'total_chunks': len(chunks)
+        })
+    return texts, ids, metadatas
+
+def load_and_chunk_documents(folder_path, collection, chunk_mode="characters", dedup=True, cache=None,
+                             near_duplicates=None, near_duplicate_threshold=0.95, pool=None, profiler=None):
+    """
+    Load documents, chunk them, and add to ChromaDB
+    
+    chunk_mode is "characters" (500-char chunks, 2-sentence overlap) or
+    "tokens" (packed to the model's token limit, 32-token overlap).
+    With dedup, identical chunk texts are embedded once and the vector is
+    shared by every chunk id that repeats them. A QueryCache passed as cache
+    is invalidated once the new chunks are written.
+    
+    near_duplicates="drop" skips chunks whose embedding is within
+    near_duplicate_threshold cosine of an earlier chunk; "link" keeps them
+    but records the earlier chunk's id as 'canonical_id' metadata.
+    An EmbeddingPool passed as pool spreads embedding across processes.
+    A profiling.Profiler passed as profiler records the load, chunk, embed
+    and add stages and the size of the chunk lists and embeddings.
+    Returns the number of chunks written to the collection.
+    """
     print("\n📚 Loading and processing company documents...")
     print("-" * 50)
     
-    documents = load_documents_from_folder(folder_path)
+    with profile_stage(profiler, 'load'):
+        documents = load_documents_from_folder(folder_path)
     
     if not documents:
         print("❌ No documents found!")
@@ -197,54 +676,536 @@ def load_and_chunk_documents(folder_path, collection):
     all_metadatas = []
     all_ids = []
     
+    stage = start_stage(profiler, 'chunk')
     for doc in documents:
         print(f"\n📄 Processing: {doc['title']}")
         print(f"   Size: {len(doc['content'])} characters")
         
-        # Chunk the document with sentence-based overlap
-        chunks = smart_chunk_document(
-            doc['content'], 
-            doc['source'],
-            chunk_size=500,
-            overlap_sentences=2  # Overlap 2 complete sentences
-        )
-        
+        chunks = chunk_document(doc, chunk_mode)
         print(f"   Created {len(chunks)} chunks")
         
         # Prepare for ChromaDB
-        for chunk in chunks:
-            chunk_id = f"{doc['source']}_{chunk['metadata']['chunk_id']}"
-            
-            all_chunks.append(chunk['text'])
-            all_ids.append(chunk_id)
-            all_metadatas.append({
-                'source': doc['source'],
-                'title': doc['title'],
-                'chunk_id': chunk['metadata']['chunk_id'],
-                'total_chunks': len(chunks)
-            })
+        texts, ids, metadatas = chunk_records(doc, chunks)
+        all_chunks.extend(texts)
+        all_ids.extend(ids)
+        all_metadatas.extend(metadatas)
         
         total_chunks += len(chunks)
+    stage.close()
+    
+    if profiler is not None:
+        profiler.account('chunk_texts', deep_sizeof(all_chunks))
+        profiler.account('chunk_ids', deep_sizeof(all_ids))
+        profiler.account('chunk_metadatas', deep_sizeof(all_metadatas))
     
     # Add all chunks to ChromaDB at once
     if all_chunks:
+        stage = start_stage(profiler, 'embed')
+        # Without precomputed embeddings Chroma embeds every chunk itself
+        embeddings = None
+        if dedup or near_duplicates or pool is not None:
+            embeddings, unique_count = embed_unique_texts(all_chunks, pool=pool)
+            dedup_ratio = 1 - unique_count / total_chunks
+            print(f"\n🧬 Embedded {unique_count} unique texts for {total_chunks} chunks "
+                  f"(dedup ratio: {dedup_ratio:.1%})")
+        
+        if near_duplicates:
+            all_chunks, all_ids, all_metadatas, embeddings, duplicates = apply_near_duplicates(
+                all_chunks, all_ids, all_metadatas, embeddings, near_duplicates, near_duplicate_threshold)
+            print(f"🪞 Found {duplicates} near-duplicate chunks (cosine >= {near_duplicate_threshold})")
+            total_chunks = len(all_chunks)
+        stage.close()
+        
+        if profiler is not None and embeddings is not None:
+            profiler.account('embeddings', int(embeddings.nbytes))
+        
+        stage = start_stage(profiler, 'add')
         print(f"\n🔄 Adding {total_chunks} chunks to ChromaDB...")
-        collection.add(
-            documents=all_chunks,
-            metadatas=all_metadatas,
-            ids=all_ids
-        )
+        # Chroma caps rows per add() call, so large corpora go in batches
+        for start in range(0, total_chunks, ADD_BATCH_SIZE):
+            stop = start + ADD_BATCH_SIZE
+            collection.add(
+                documents=all_chunks[start:stop],
+                embeddings=None if embeddings is None else embeddings[start:stop],
+                metadatas=all_metadatas[start:stop],
+                ids=all_ids[start:stop]
+            )
+        stage.close()
         print(f"✅ Successfully indexed {total_chunks} chunks from {len(documents)} documents")
+        
+        if cache is not None:
+            cache.invalidate()
     
     return total_chunks
 
-def search_documents(collection, query, n_results=3):
-    """Search across all document chunks"""
-    results = collection.query(
-        query_texts=[query],
-        n_results=n_results
-    )
+def scan_markdown_files(folder_path):
+    """
+    Map every .md file under folder_path (recursively) to (mtime_ns, size).
+    
+    os.scandir entries carry their stat data, so nothing is opened or read.
+    Keys are paths relative to folder_path, joined with '/'.
+    """
+    found = {}
+    pending = ['']
+    while pending:
+        relative = pending.pop()
+        try:
+            entries = os.scandir(os.path.join(folder_path, relative))
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue
+        with entries:
+            for entry in entries:
+                path = f"{relative}/{entry.name}" if relative else entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(path)
+                    elif entry.name.endswith('.md') and entry.is_file():
+                        stat = entry.stat()
+                        found[path] = (stat.st_mtime_ns, stat.st_size)
+                except FileNotFoundError:
+                    continue  # removed mid-scan
+    return found
+
+def diff_scans(before, after):
+    """(changed, deleted) relative paths between two scan_markdown_files() results"""
+    changed = [path for path, state in after.items() if before.get(path) != state]
+    deleted = [path for path in before if path not in after]
+    return changed, deleted
+
+def read_document(folder_path, relative_path):
+    """Load one markdown file in the same shape as load_documents_from_folder()"""
+    with open(os.path.join(folder_path, relative_path), 'r') as f:
+        content = f.read()
+    name = os.path.basename(relative_path)
+    return {
+        'content': content,
+        'source': relative_path,
+        'title': name.replace('.md', '').replace('_', ' ').title()
+    }
+
+def sync_documents(collection, folder_path, changed, deleted, chunk_mode="characters", cache=None,
+                   dedup=True, near_duplicates=None, near_duplicate_threshold=0.95, doc_index=None):
+    """
+    Re-index only the given documents.
+    
+    Changed documents are re-chunked, embedded and upserted, then any of
+    their old chunk ids that no longer exist are deleted, so readers never
+    see a gap. Deleted documents lose all their chunks. dedup and
+    near_duplicates behave as in load_and_chunk_documents(), with new
+    chunks also checked against the rest of the collection. A QueryCache is
+    invalidated and a DocumentIndex has the affected summaries recomputed.
+    Returns (chunks_written, chunks_removed).
+    """
+    texts, ids, metadatas = [], [], []
+    current_ids = {}
+    for source in changed:
+        try:
+            doc = read_document(folder_path, source)
+        except FileNotFoundError:
+            deleted = list(deleted) + [source]  # gone again before we read it
+            continue
+        doc_texts, doc_ids, doc_metadatas = chunk_records(doc, chunk_document(doc, chunk_mode))
+        texts.extend(doc_texts)
+        ids.extend(doc_ids)
+        metadatas.extend(doc_metadatas)
+        current_ids[source] = set()
+    
+    if texts:
+        # Without precomputed embeddings Chroma embeds every chunk itself
+        embeddings = None
+        if dedup or near_duplicates:
+            embeddings, _ = embed_unique_texts(texts)
+        if near_duplicates:
+            texts, ids, metadatas, embeddings, _ = apply_near_duplicates(
+                texts, ids, metadatas, embeddings, near_duplicates, near_duplicate_threshold,
+                collection=collection, exclude_sources=list(current_ids) + list(deleted))
+        for metadata, chunk_id in zip(metadatas, ids):
+            current_ids[metadata['source']].add(chunk_id)
+        for start in range(0, len(texts), ADD_BATCH_SIZE):
+            stop = start + ADD_BATCH_SIZE
+            collection.upsert(
+                ids=ids[start:stop],
+                documents=texts[start:stop],
+                embeddings=None if embeddings is None else embeddings[start:stop],
+                metadatas=metadatas[start:stop]
+            )
     
+    removed = 0
+    for source in list(current_ids) + list(deleted):
+        existing = collection.get(where={"source": source}, include=[])['ids']
+        stale = [chunk_id for chunk_id in existing if chunk_id not in current_ids.get(source, ())]
+        if stale:
+            collection.delete(ids=stale)
+            removed += len(stale)
+    
+    if cache is not None and (texts or removed):
+        cache.invalidate()
+    if doc_index is not None:
+        doc_index.refresh(collection, list(current_ids) + list(deleted))
+    return len(texts), removed
+
+class InotifyWaker:
+    """
+    Block until something under a folder changes (Linux, optional inotify_simple).
+    
+    Only used to wake the watch loop; the stat scan still decides what changed.
+    """
+    
+    def __init__(self, folder_path):
+        from inotify_simple import INotify, flags
+        
+        self.flags = flags
+        self.inotify = INotify()
+        self.mask = (flags.CREATE | flags.CLOSE_WRITE | flags.MODIFY | flags.DELETE
+                     | flags.MOVED_FROM | flags.MOVED_TO)
+        self.folder_path = folder_path
+        self.watched = {}   # watch descriptor -> directory
+        self.add_watches()
+    
+    def add_watches(self):
+        """Watch every directory under the folder that is not watched yet"""
+        known = set(self.watched.values())
+        for root, _, _ in os.walk(self.folder_path):
+            if root not in known:
+                try:
+                    self.watched[self.inotify.add_watch(root, self.mask)] = root
+                except OSError:
+                    pass
+    
+    def wait(self, timeout):
+        """True if any event arrived within timeout seconds"""
+        events = self.inotify.read(timeout=int(timeout * 1000))
+        for event in events:
+            if event.mask & self.flags.IGNORED:
+                self.watched.pop(event.wd, None)
+        if any(event.mask & (self.flags.ISDIR | self.flags.Q_OVERFLOW) for event in events):
+            self.add_watches()
+        return bool(events)
+    
+    def close(self):
+        self.inotify.close()
+
+def watch_folder(folder_path, collection, chunk_mode="characters", cache=None, interval=1.0,
+                 debounce=0.5, baseline=None, stop_event=None, use_inotify=True, dedup=True,
+                 near_duplicates=None, near_duplicate_threshold=0.95, doc_index=None):
+    """
+    Keep the collection in sync with folder_path until stop_event is set.
+    
+    Polls scan_markdown_files() every interval seconds. With inotify_simple
+    installed on Linux, filesystem events wake the loop instead and idle
+    periods cost nothing. A burst of changes is applied once the folder has
+    been quiet for debounce seconds, and only the affected documents are
+    re-chunked and re-embedded, with the same dedup / near_duplicates
+    options as the initial load; doc_index and cache are kept in step.
+    After each sync the collection is marked current, so a warm start
+    skips ingestion. baseline is the scan the collection already reflects
+    (defaults to the folder as it is now).
+    """
+    known = scan_markdown_files(folder_path) if baseline is None else baseline
+    waker = None
+    if use_inotify:
+        try:
+            waker = InotifyWaker(folder_path)
+        except (ImportError, OSError):
+            waker = None
+    
+    last_scan = known
+    quiet_since = None
+    # Scan once before the first wait: edits made since baseline was taken
+    # raised no inotify event the waker could have seen
+    scan_now = True
+    try:
+        while not (stop_event is not None and stop_event.is_set()):
+            timeout = interval if quiet_since is None else min(interval, debounce)
+            if scan_now:
+                scan_now = False
+            elif waker is not None:
+                if not waker.wait(timeout) and quiet_since is None:
+                    continue
+            elif stop_event is not None:
+                stop_event.wait(timeout)
+            else:
+                time.sleep(timeout)
+            
+            current = scan_markdown_files(folder_path)
+            if current != last_scan:
+                # Still changing: restart the quiet period
+                last_scan = current
+                quiet_since = time.monotonic()
+                continue
+            if quiet_since is None or time.monotonic() - quiet_since < debounce:
+                continue
+            
+            changed, deleted = diff_scans(known, current)
+            quiet_since = None
+            if not changed and not deleted:
+                continue
+            start = time.perf_counter()
+            # Fingerprint before reading: an edit racing the sync then forces a rebuild, never a stale skip
+            fingerprint = corpus_fingerprint(folder_path, chunk_mode)
+            written, removed = sync_documents(collection, folder_path, changed, deleted, chunk_mode, cache,
+                                              dedup, near_duplicates, near_duplicate_threshold, doc_index)
+            mark_collection_current(collection, fingerprint)
+            known = current
+            print(f"🔁 Synced {len(changed)} changed / {len(deleted)} deleted document(s): "
+                  f"{written} chunks written, {removed} removed in {time.perf_counter() - start:.2f}s")
+    finally:
+        if waker is not None:
+            waker.close()
+
+def import_embeddings(collection, vectors_path, sidecar_path, batch_size=1000, cache=None):
+    """
+    Upsert a precomputed embedding bundle (see embedding_io) into the collection.
+    
+    Vectors are passed with embeddings=, so the model never runs. The bundle's
+    model tag and dimensions must match this collection.
+    """
+    from embedding_io import read_bundle
+    
+    imported = 0
+    for ids, texts, metadatas, vectors in read_bundle(vectors_path, sidecar_path,
+                                                      expected_model=EMBEDDING_MODEL_NAME,
+                                                      expected_dims=EMBEDDING_DIMENSIONS,
+                                                      batch_size=batch_size):
+        collection.upsert(
+            ids=ids,
+            embeddings=vectors,
+            documents=texts,
+            # Chroma rejects empty metadata dicts
+            metadatas=[m or None for m in metadatas]
+        )
+        imported += len(ids)
+    
+    if cache is not None:
+        cache.invalidate()
+    return imported
+
+def export_embeddings(collection, vectors_path, sidecar_path, batch_size=1000):
+    """Write every chunk, its metadata and its stored vector as an embedding bundle"""
+    from embedding_io import BundleWriter
+    
+    count = collection.count()
+    with BundleWriter(vectors_path, sidecar_path, EMBEDDING_MODEL_NAME, EMBEDDING_DIMENSIONS, count) as writer:
+        for offset in range(0, count, batch_size):
+            batch = collection.get(
+                include=['embeddings', 'documents', 'metadatas'],
+                limit=batch_size,
+                offset=offset
+            )
+            writer.write_batch(batch['ids'], batch['documents'], batch['metadatas'], batch['embeddings'])
+    return count
+
+class QueryCache:
+    """
+    Two-level cache in front of search_documents.
+    
+    Level 1 is an exact LRU over normalized query strings. Level 2 serves a
+    cached result when a new query embedding lies within max_distance (cosine
+    distance) of a recent one, so paraphrases skip the Chroma round trip.
+    Entries expire after ttl_seconds; call invalidate() after any collection write.
+    Every public method holds the cache's own lock, so threads can share one cache.
+    A lookup that misses gets the current generation from record_miss() and
+    hands it to put(); if invalidate() ran in between, the possibly stale
+    results are not stored.
+    """
+    
+    def __init__(self, max_entries=256, ttl_seconds=300, max_distance=0.05):
+        if max_entries < 1:
+            raise ValueError(f"max_entries must be at least 1, got {max_entries}")
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_distance = max_distance
+        self.entries = OrderedDict()   # normalized query -> entry
+        self.vectors = None            # unit query vectors, one row per slot
+        self.free_rows = list(range(max_entries))
+        self.row_keys = {}             # slot row -> normalized query
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.generation = 0            # bumped by invalidate()
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def normalize(query):
+        """Collapse whitespace and case so trivial variants share an entry"""
+        return ' '.join(query.split()).lower()
+    
+    def _expired(self, entry):
+        return time.monotonic() - entry['created'] > self.ttl_seconds
+    
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        del self.row_keys[entry['row']]
+        self.free_rows.append(entry['row'])
+    
+    def get(self, query, n_results):
+        """Level 1: exact match on the normalized query"""
+        key = self.normalize(query)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self._expired(entry):
+                self._remove(key)
+                entry = None
+            if entry is None or entry['n_results'] < n_results:
+                return None
+            self.entries.move_to_end(key)
+            self.exact_hits += 1
+            return list(entry['results'][:n_results])
+    
+    def get_similar(self, query_vector, n_results):
+        """Level 2: nearest cached query embedding within max_distance"""
+        unit = query_vector / (np.linalg.norm(query_vector) or 1.0)
+        with self.lock:
+            if not self.row_keys:
+                return None
+            rows = np.fromiter(self.row_keys.keys(), dtype=np.intp)
+            similarities = self.vectors[rows] @ unit
+            
+            for i in np.argsort(-similarities):
+                if 1 - similarities[i] > self.max_distance:
+                    break
+                key = self.row_keys[rows[i]]
+                entry = self.entries[key]
+                if self._expired(entry):
+                    self._remove(key)
+                    continue
+                if entry['n_results'] >= n_results:
+                    self.entries.move_to_end(key)
+                    self.semantic_hits += 1
+                    return list(entry['results'][:n_results])
+            return None
+    
+    def record_miss(self):
+        """Count a lookup that neither level answered; returns the generation to pass to put()"""
+        with self.lock:
+            self.misses += 1
+            return self.generation
+    
+    def put(self, query, query_vector, n_results, results, generation=None):
+        """Store results, evicting the least recently used entry when full (skipped if invalidated since generation)"""
+        key = self.normalize(query)
+        unit = query_vector / (np.linalg.norm(query_vector) or 1.0)
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self.entries:
+                self._remove(key)
+            elif len(self.entries) >= self.max_entries:
+                self._remove(next(iter(self.entries)))
+            
+            if self.vectors is None:
+                self.vectors = np.zeros((self.max_entries, len(query_vector)), dtype=np.float32)
+            row = self.free_rows.pop()
+            self.vectors[row] = unit
+            self.row_keys[row] = key
+            self.entries[key] = {
+                'results': list(results),
+                'n_results': n_results,
+                'row': row,
+                'created': time.monotonic()
+            }
+    
+    def invalidate(self):
+        """Drop every entry (the collection changed underneath us)"""
+        with self.lock:
+            self.entries.clear()
+            self.row_keys.clear()
+            self.free_rows = list(range(self.max_entries))
+            self.invalidations += 1
+            self.generation += 1
+    
+    def stats(self):
+        """Hit-rate metrics for both cache levels"""
+        with self.lock:
+            lookups = self.exact_hits + self.semantic_hits + self.misses
+            return {
+                'lookups': lookups,
+                'exact_hits': self.exact_hits,
+                'semantic_hits': self.semantic_hits,
+                'misses': self.misses,
+                'hit_rate': (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0,
+                'entries': len(self.entries),
+                'invalidations': self.invalidations
+            }
+
+class DocumentIndex:
+    """
+    Coarse index holding one summary vector per source document.
+    
+    Each summary is the normalized mean of the document's chunk embeddings.
+    Searching it narrows a query to a few documents, whose chunks are then
+    searched with a metadata filter. Call build() again after ingestion,
+    or refresh() with just the documents that changed.
+    """
+    
+    def __init__(self):
+        self.sources = []
+        self.centroids = None
+        self.chunk_counts = None
+        self.total_chunks = 0
+    
+    def build(self, collection, batch_size=ADD_BATCH_SIZE):
+        """Average every stored chunk embedding into its source's summary vector"""
+        self.sources, self.centroids, self.chunk_counts = self.summarize(collection, batch_size=batch_size)
+        self.total_chunks = int(self.chunk_counts.sum())
+        return self
+    
+    def refresh(self, collection, sources, batch_size=ADD_BATCH_SIZE):
+        """Recompute the summaries of the given sources only; sources with no chunks left are dropped"""
+        if self.centroids is None:
+            return self.build(collection, batch_size)
+        sources = set(sources)
+        if not sources:
+            return self
+        new_sources, new_centroids, new_counts = self.summarize(
+            collection, where={"source": {"$in": sorted(sources)}}, batch_size=batch_size)
+        keep = [i for i, source in enumerate(self.sources) if source not in sources]
+        self.sources = [self.sources[i] for i in keep] + new_sources
+        self.centroids = np.vstack([self.centroids[keep], new_centroids])
+        self.chunk_counts = np.concatenate([self.chunk_counts[keep], new_counts])
+        self.total_chunks = int(self.chunk_counts.sum())
+        return self
+    
+    @staticmethod
+    def summarize(collection, where=None, batch_size=ADD_BATCH_SIZE):
+        """(sources, normalized mean vectors, chunk counts) over the stored chunks matching where"""
+        positions = {}
+        sums = np.zeros((0, EMBEDDING_DIMENSIONS), dtype=np.float32)
+        counts = np.zeros(0, dtype=np.int64)
+        offset = 0
+        while True:
+            batch = collection.get(where=where, include=['embeddings', 'metadatas'], limit=batch_size, offset=offset)
+            if not len(batch['ids']):
+                break
+            vectors = np.asarray(batch['embeddings'], dtype=np.float32)
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors /= np.where(norms == 0, 1, norms)
+            rows = np.array([positions.setdefault(m['source'], len(positions)) for m in batch['metadatas']])
+            if len(positions) > len(sums):
+                sums = np.vstack([sums, np.zeros((len(positions) - len(sums), vectors.shape[1]), dtype=np.float32)])
+                counts = np.concatenate([counts, np.zeros(len(positions) - len(counts), dtype=np.int64)])
+            np.add.at(sums, rows, vectors)
+            counts += np.bincount(rows, minlength=len(counts))
+            offset += len(batch['ids'])
+        
+        lengths = np.linalg.norm(sums, axis=1, keepdims=True)
+        return list(positions), sums / np.where(lengths == 0, 1, lengths), counts
+    
+    def search(self, query_vector, n_documents=5):
+        """Sources of the n_documents summaries closest to the query"""
+        if not self.sources:
+            return []
+        rows, _ = top_k_search(query_vector, self.centroids, n_documents)
+        return [self.sources[row] for row in rows[0]]
+    
+    def chunk_count(self, sources):
+        """Number of chunks stored for the given sources"""
+        index = {source: i for i, source in enumerate(self.sources)}
+        return int(sum(self.chunk_counts[index[source]] for source in sources))
+
+def format_query_results(results):
+    """Flatten a single-query Chroma result into text/metadata/similarity dicts"""
     formatted_results = []
     if results['documents'] and results['documents'][0]:
         for i in range(len(results['documents'][0])):
@@ -254,22 +1215,432 @@ def search_documents(collection, query, n_results=3):
                 'distance': results['distances'][0][i],
                 'similarity': 1 - results['distances'][0][i]
             })
+    return formatted_results
+
+def search_documents(collection, query, n_results=3, cache=None):
+    """Search across all document chunks, optionally through a QueryCache"""
+    if cache is None:
+        results = collection.query(
+            query_texts=[query],
+            n_results=n_results
+        )
+    else:
+        cached = cache.get(query, n_results)
+        if cached is not None:
+            return cached
+        
+        query_vector = get_embedding_model().encode(query, convert_to_numpy=True)
+        cached = cache.get_similar(query_vector, n_results)
+        if cached is not None:
+            return cached
+        
+        generation = cache.record_miss()
+        results = collection.query(
+            query_embeddings=[query_vector],
+            n_results=n_results
+        )
+    
+    formatted_results = format_query_results(results)
+    
+    if cache is not None:
+        cache.put(query, query_vector, n_results, formatted_results, generation)
+    
+    return formatted_results
+
+def search_documents_hierarchical(collection, doc_index, query, n_results=3, n_documents=5):
+    """
+    Two-level search: the n_documents best source documents by summary
+    vector, then the best chunks among only those documents.
+    """
+    query_vector = get_embedding_model().encode(query, convert_to_numpy=True)
+    sources = doc_index.search(query_vector, n_documents)
+    if not sources:
+        return []
+    results = collection.query(
+        query_embeddings=[query_vector],
+        n_results=n_results,
+        where={"source": {"$in": sources}}
+    )
+    return format_query_results(results)
+
+def evaluate_hierarchical(collection, doc_index, queries, n_results=3, document_counts=(1, 2, 4, 8)):
+    """
+    Recall@n_results of hierarchical search against a flat search, for each D.
+    
+    Also reports the share of chunks the second level is restricted to and
+    the average latency of both modes.
+    """
+    query_vectors = get_embedding_model().encode(list(queries), convert_to_numpy=True)
+    start = time.perf_counter()
+    flat = [set(collection.query(query_embeddings=[qv], n_results=n_results)['ids'][0])
+            for qv in query_vectors]
+    flat_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    
+    report = []
+    for n_documents in document_counts:
+        hits = 0
+        candidates = 0
+        start = time.perf_counter()
+        for qv, truth in zip(query_vectors, flat):
+            sources = doc_index.search(qv, n_documents)
+            found = collection.query(query_embeddings=[qv], n_results=n_results,
+                                     where={"source": {"$in": sources}})['ids'][0]
+            hits += len(truth & set(found))
+            candidates += doc_index.chunk_count(sources)
+        latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        report.append({
+            'documents': n_documents,
+            'recall': hits / max(1, sum(len(t) for t in flat)),
+            'candidate_fraction': candidates / (len(queries) * max(1, doc_index.total_chunks)),
+            'latency_ms': latency_ms,
+            'flat_latency_ms': flat_ms
+        })
+    return report
+
+def search_documents_range(collection, query, min_similarity, max_results=None, initial_results=8):
+    """
+    All chunks with similarity >= min_similarity, best first.
     
+    Chroma only answers top-n queries, so this over-fetches adaptively: start
+    at initial_results and double n only while every returned chunk still
+    clears the threshold. The query is embedded once for all rounds. Recall
+    is bounded by the HNSW index, as for any other Chroma query.
+    """
+    total = collection.count()
+    if total == 0:
+        return []
+    query_vector = get_embedding_model().encode(query, convert_to_numpy=True)
+    limit = min(max_results or total, total)
+    n_results = min(initial_results, limit)
+    
+    while True:
+        results = collection.query(
+            query_embeddings=[query_vector],
+            n_results=n_results
+        )
+        distances = results['distances'][0]
+        # Results are sorted, so the last one decides whether to fetch more
+        if len(distances) < n_results or 1 - distances[-1] < min_similarity or n_results >= limit:
+            break
+        n_results = min(n_results * 2, limit)
+    
+    formatted_results = []
+    for text, metadata, distance in zip(results['documents'][0], results['metadatas'][0], distances):
+        if 1 - distance < min_similarity:
+            break
+        formatted_results.append({
+            'text': text,
+            'metadata': metadata,
+            'distance': distance,
+            'similarity': 1 - distance
+        })
     return formatted_results
 
-def main():
+def reopen_collection(store_path, embedding_function=None, client=None):
+    """
+    Close our client and reopen the persisted collection on a fresh one.
+    
+    Loaded HNSW segments keep the search settings they were opened with,
+    so configuration changes only apply after a reopen. Only `client` is
+    closed; other clients on the same path (e.g. a CollectionPool) are left
+    working, but Chroma shares one system per path, so new settings load
+    only once every client on store_path has been closed. Earlier handles
+    from `client` are stale afterwards.
+    """
+    if client is not None:
+        client.close()
+    client = chromadb.PersistentClient(path=store_path)
+    collection = client.get_collection(
+        name=COLLECTION_NAME,
+        embedding_function=embedding_function or get_embedding_function()
+    )
+    return client, collection
+
+def autotune_collection(store_path, target_recall=0.95, top_k=5, n_queries=50,
+                        ef_values=(10, 20, 40, 80, 160, 320), seed=0, embedding_function=None,
+                        client=None):
+    """
+    Tune the HNSW ef_search knob to the cheapest value meeting target_recall.
+    
+    A random sample of stored chunks is held out as queries and exact cosine
+    search over every stored embedding is the ground truth (each query's own
+    chunk is excluded). ef_search is persisted in the collection
+    configuration and the measured outcome in its metadata. Pass the
+    caller's client so it is closed before each reopen; any other client
+    still open on store_path keeps the old ef_search loaded (see
+    reopen_collection).
+    
+    Returns (client, collection, report); use the returned handles from then on.
+    """
+    client, collection = reopen_collection(store_path, embedding_function, client)
+    data = collection.get(include=['embeddings'])
+    ids = data['ids']
+    if len(ids) < 2:
+        return client, collection, None
+    matrix = np.asarray(data['embeddings'], dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    held_out = rng.choice(len(ids), min(n_queries, len(ids)), replace=False)
+    queries = matrix[held_out]
+    top_k = min(top_k, len(ids) - 1)
+    
+    truth_rows, _ = top_k_search(queries, matrix, top_k + 1)
+    truth = [{ids[r] for r in [r for r in rows if r != q][:top_k]}
+             for q, rows in zip(held_out.tolist(), truth_rows.tolist())]
+    
+    trials = []
+    for ef in sorted(set(max(ef, top_k + 1) for ef in ef_values)):
+        collection.modify(configuration={"hnsw": {"ef_search": ef}})
+        client, collection = reopen_collection(store_path, embedding_function, client)
+        start = time.perf_counter()
+        results = collection.query(query_embeddings=queries, n_results=top_k + 1, include=['distances'])
+        latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        hits = sum(len(t & set(found)) for t, found in zip(truth, results['ids']))
+        trials.append({'ef_search': ef, 'recall': hits / sum(len(t) for t in truth), 'latency_ms': latency_ms})
+        if trials[-1]['recall'] >= target_recall:
+            break
+    
+    best = trials[-1]
+    # modify() replaces user metadata, so carry the existing keys over
+    metadata = {k: v for k, v in (collection.metadata or {}).items() if not k.startswith("hnsw:")}
+    metadata.update({
+        "tuned_ef_search": best['ef_search'],
+        "tuned_recall": best['recall'],
+        "tuned_top_k": top_k,
+        "tuned_target_recall": target_recall
+    })
+    collection.modify(metadata=metadata)
+    report = {'strategy': 'hnsw', 'top_k': top_k, 'target_recall': target_recall,
+              'ef_search': best['ef_search'], 'recall': best['recall'],
+              'latency_ms': best['latency_ms'], 'trials': trials}
+    return client, collection, report
+
+class CollectionPool:
+    """
+    Per-tenant collections on one shared PersistentClient.
+    
+    Tenant 'hr' lives in collection 'company_docs_hr'. Collections are opened
+    (or created) lazily on first use and all share one embedding function,
+    so the model is loaded once however many tenants are served. At most
+    max_open tenants keep a handle and a QueryCache in memory; the least
+    recently used one is evicted when another is opened. Chroma keeps its
+    own LRU of loaded HNSW indexes, so an evicted tenant reopens quickly.
+    Thread-safe: concurrent callers can route by tenant id.
+    """
+    
+    TENANT_PATTERN = re.compile(r'[A-Za-z0-9][A-Za-z0-9_-]{0,62}')
+    
+    def __init__(self, store_path="./chroma_db", max_open=8, embedding_function=None, client=None,
+                 cache_distance=0.05):
+        self.client = client or chromadb.PersistentClient(path=store_path)
+        self.embedding_function = embedding_function or get_embedding_function()
+        self.max_open = max_open
+        self.cache_distance = cache_distance
+        self.open = OrderedDict()   # tenant -> (collection, QueryCache)
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.evictions = 0
+        self.hits = 0
+    
+    def collection_name(self, tenant):
+        if not self.TENANT_PATTERN.fullmatch(tenant):
+            raise ValueError(f"Invalid tenant id {tenant!r}: use letters, digits, '_' or '-'")
+        return f"{COLLECTION_NAME}_{tenant}"
+    
+    def entry(self, tenant):
+        """(collection, cache) for a tenant, opening it and evicting the LRU tenant if needed"""
+        name = self.collection_name(tenant)
+        with self.lock:
+            entry = self.open.get(tenant)
+            if entry is not None:
+                self.open.move_to_end(tenant)
+                self.hits += 1
+                return entry
+            
+            collection = self.client.get_or_create_collection(
+                name=name,
+                embedding_function=self.embedding_function,
+                metadata={
+                    "hnsw:space": "cosine",
+                    "embedding_model": EMBEDDING_MODEL_NAME,
+                    "schema_version": SCHEMA_VERSION,
+                    "tenant": tenant
+                }
+            )
+            entry = (collection, QueryCache(max_distance=self.cache_distance))
+            self.open[tenant] = entry
+            self.opened += 1
+            while len(self.open) > self.max_open:
+                self.open.popitem(last=False)
+                self.evictions += 1
+            return entry
+    
+    def get(self, tenant):
+        """The tenant's collection"""
+        return self.entry(tenant)[0]
+    
+    def search(self, tenant, query, n_results=3):
+        """search_documents against the tenant's collection, through its query cache"""
+        collection, cache = self.entry(tenant)
+        return search_documents(collection, query, n_results=n_results, cache=cache)
+    
+    def ingest(self, tenant, folder_path, chunk_mode="characters", **kwargs):
+        """load_and_chunk_documents into the tenant's collection; returns the chunk count"""
+        collection, cache = self.entry(tenant)
+        return load_and_chunk_documents(folder_path, collection, chunk_mode=chunk_mode, cache=cache, **kwargs)
+    
+    def evict(self, tenant):
+        """Release a tenant's handle and cache (the data stays on disk)"""
+        with self.lock:
+            if self.open.pop(tenant, None) is not None:
+                self.evictions += 1
+    
+    def drop(self, tenant):
+        """Delete a tenant's collection and everything in it"""
+        name = self.collection_name(tenant)
+        with self.lock:
+            self.open.pop(tenant, None)
+            self.client.delete_collection(name=name)
+    
+    def tenants(self):
+        """Every tenant with a collection in the store, open or not"""
+        prefix = f"{COLLECTION_NAME}_"
+        names = [getattr(collection, 'name', collection) for collection in self.client.list_collections()]
+        return sorted(name[len(prefix):] for name in names if name.startswith(prefix))
+    
+    def stats(self):
+        """Open-handle and eviction counts"""
+        with self.lock:
+            return {
+                'open': list(self.open),
+                'max_open': self.max_open,
+                'opened': self.opened,
+                'hits': self.hits,
+                'evictions': self.evictions
+            }
+
+def write_profile(profiler, path, store_path, collection, cache=None, doc_index=None):
+    """Account the vector store and in-process indexes, then write and summarize the profile"""
+    profiler.account('chroma_store', store_memory_usage(store_path, collection))
+    if cache is not None:
+        profiler.account('query_cache', deep_sizeof(cache))
+    if doc_index is not None:
+        profiler.account('document_index', deep_sizeof(doc_index))
+    profiler.write(path)
+    profiler.print_summary()
+    print(f"💾 Memory profile written to {path}")
+
+def parse_args(argv=None):
+    """Command line options for the production pipeline"""
+    parser = argparse.ArgumentParser(description="Lab 4: Production Vector Database with ChromaDB")
+    parser.add_argument("--chunk-mode", choices=["characters", "tokens"], default="characters",
+                        help="Size chunks by characters (default) or by model tokens")
+    parser.add_argument("--cache-distance", type=float, default=0.05,
+                        help="Max cosine distance for a semantic query-cache hit")
+    parser.add_argument("--near-duplicates", choices=["drop", "link"],
+                        help="Drop near-duplicate chunks or link them to a canonical chunk id")
+    parser.add_argument("--embed-workers", type=int, default=0,
+                        help="Embed chunks in N worker processes (0 = in this process)")
+    parser.add_argument("--autotune", type=float, metavar="RECALL",
+                        help="Tune HNSW ef_search to the cheapest value reaching this recall@k")
+    parser.add_argument("--hierarchical", type=int, metavar="D",
+                        help="Search the D best documents by summary vector, then their chunks")
+    parser.add_argument("--watch", action="store_true",
+                        help="After ingestion, keep the index in sync with ./docs until Ctrl+C")
+    parser.add_argument("--watch-interval", type=float, default=1.0,
+                        help="Seconds between change scans in watch mode")
+    parser.add_argument("--warm-start", action="store_true",
+                        help="Reuse the persisted collection and skip ingestion when it is current")
+    parser.add_argument("--store", default="./chroma_db",
+                        help="ChromaDB persistence directory")
+    parser.add_argument("--restore", metavar="ARCHIVE",
+                        help="Restore the store from a snapshot before starting (implies --warm-start)")
+    parser.add_argument("--snapshot", metavar="ARCHIVE_BASE",
+                        help="Write a .tar.gz snapshot of the store after ingestion")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="Write a per-stage tracemalloc/RSS memory report to PATH (JSON)")
+    return parser.parse_args(argv)
+
+def main(args=None):
     """Production vector database with real documents"""
+    if args is None:
+        args = parse_args()
+    
     print("=" * 70)
     print("🚀 Lab 4: Production Vector Database with ChromaDB")
     print("=" * 70)
     print("\nBuilding a REAL semantic search system with actual documents!")
     
+    profiler = Profiler().start() if args.profile else None
+    
+    if args.restore:
+        restore_store(args.restore, args.store)
+        args.warm_start = True
+    
     # Setup ChromaDB with real embeddings
-    client, collection = setup_chromadb()
+    client, collection = setup_chromadb(warm_start=args.warm_start, store_path=args.store)
     
     # Load and process documents
     docs_folder = "./docs"
-    total_chunks = load_and_chunk_documents(docs_folder, collection)
+    cache = QueryCache(max_distance=args.cache_distance)
+    fingerprint = corpus_fingerprint(docs_folder, args.chunk_mode)
+    # What the ingestion below will reflect; taken first so edits made
+    # during ingestion are caught by watch mode
+    baseline = scan_markdown_files(docs_folder)
+    
+    if args.warm_start and is_collection_current(collection, fingerprint):
+        total_chunks = collection.count()
+        print(f"\n⏩ Index is current ({total_chunks} chunks), skipping ingestion")
+    else:
+        if args.warm_start and collection.count() > 0:
+            # Documents changed since the index was built
+            collection = reset_collection(client, get_embedding_function())
+        pool = None
+        if args.embed_workers:
+            from embedding_pool import EmbeddingPool
+            pool = EmbeddingPool(n_workers=args.embed_workers, model_name=EMBEDDING_MODEL_NAME).start()
+        try:
+            total_chunks = load_and_chunk_documents(docs_folder, collection, chunk_mode=args.chunk_mode, cache=cache,
+                                                    near_duplicates=args.near_duplicates, pool=pool,
+                                                    profiler=profiler)
+        except BaseException:
+            if profiler is not None:
+                # Keep the stages measured before the failure
+                print("\n⚠️  Ingestion failed, writing the partial memory profile")
+                write_profile(profiler, args.profile, args.store, collection, cache)
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+        if total_chunks:
+            mark_collection_current(collection, fingerprint)
+    
+    if args.autotune and total_chunks:
+        # Handles are replaced: tuning reopens the store so the new ef_search loads
+        client, collection, report = autotune_collection(args.store, target_recall=args.autotune, client=client)
+        if report:
+            print(f"🧭 Tuned HNSW ef_search={report['ef_search']} "
+                  f"(recall@{report['top_k']} {report['recall']:.0%}, {report['latency_ms']:.2f} ms/query)")
+    
+    if args.snapshot:
+        snapshot_store(args.store, args.snapshot, client)
+        client, collection = reopen_collection(args.store)
+    
+    doc_index = None
+    if args.hierarchical:
+        doc_index = DocumentIndex().build(collection)
+        print(f"\n🗂️  Document index: {len(doc_index.sources)} summary vectors over {doc_index.total_chunks} chunks")
+    
+    if args.watch:
+        if profiler is not None:
+            write_profile(profiler, args.profile, args.store, collection, cache, doc_index)
+        print(f"\n👀 Watching {docs_folder} for changes (Ctrl+C to stop)...")
+        try:
+            watch_folder(docs_folder, collection, chunk_mode=args.chunk_mode, cache=cache,
+                         interval=args.watch_interval, baseline=baseline,
+                         near_duplicates=args.near_duplicates, doc_index=doc_index)
+        except KeyboardInterrupt:
+            print("\n👋 Stopped watching")
+        return
     
     if total_chunks == 0:
         print("\n❌ No documents to search!")
@@ -293,11 +1664,16 @@ def main():
     
     print("\nTesting with common employee questions:\n")
     
+    stage = start_stage(profiler, 'query')
     for query in test_queries:
         print(f"❓ Question: '{query}'")
         print("-" * 50)
         
-        results = search_documents(collection, query, n_results=1)
+        if doc_index is not None:
+            results = search_documents_hierarchical(collection, doc_index, query, n_results=1,
+                                                    n_documents=args.hierarchical)
+        else:
+            results = search_documents(collection, query, n_results=1, cache=cache)
         
         if results:
             best = results[0]
@@ -328,6 +1704,26 @@ def main():
             print("   ❌ No relevant information found")
         
         print()
+    stage.close()
+    
+    if profiler is not None:
+        write_profile(profiler, args.profile, args.store, collection, cache, doc_index)
+        print()
+    
+    if doc_index is not None:
+        print("📊 Hierarchical recall@3 vs flat search:")
+        counts = sorted({1, args.hierarchical, len(doc_index.sources)})
+        for row in evaluate_hierarchical(collection, doc_index, test_queries, n_results=3, document_counts=counts):
+            print(f"   D={row['documents']:<3} recall {row['recall']:.0%}, "
+                  f"searching {row['candidate_fraction']:.0%} of chunks, {row['latency_ms']:.1f} ms/query")
+        print()
+    
+    # Threshold-driven search: every chunk above a similarity floor, no n_results guess
+    range_query = "Can I work from home?"
+    matches = search_documents_range(collection, range_query, min_similarity=0.5)
+    print(f"🎯 Range search '{range_query}' (similarity >= 50%): {len(matches)} chunk(s)")
+    for match in matches[:5]:
+        print(f"   • {match['metadata']['title']} (Chunk {match['metadata']['chunk_id'] + 1}, {match['similarity']:.1%})")
     
     # Interactive search
     print("\n" + "=" * 70)
@@ -342,7 +1738,7 @@ def main():
         if user_query.lower() in ['done', 'quit', 'exit', '']:
             break
         
-        results = search_documents(collection, user_query, n_results=3)
+        results = search_documents(collection, user_query, n_results=3, cache=cache)
         
         if results:
             # Show the best match with full content
@@ -425,6 +1821,7 @@ def main():
     print("📊 VECTOR DATABASE STATISTICS")
     print("=" * 70)
     
+    cache_stats = cache.stats()
     print(f"""
 ✅ System Performance:
    • Documents processed: 4
@@ -432,6 +1829,7 @@ def main():
    • Embedding dimensions: 384 (all-MiniLM-L6-v2)
    • Storage: Persistent ChromaDB
    • Search method: Cosine similarity
+   • Query cache: {cache_stats['hit_rate']:.0%} hit rate ({cache_stats['exact_hits']} exact, {cache_stats['semantic_hits']} semantic, {cache_stats['misses']} misses)
    
 🎯 Key Achievements:
    • Real documents with actual company policies
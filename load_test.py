@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Load test for the lab 4 pipeline at production scale
+
+Generates a deterministic corpus of markdown policy files, ingests it with
+load_and_chunk_documents, then runs search_documents from concurrent
+clients for a fixed duration. Reports ingest throughput, query QPS, latency
+percentiles and resident memory over time.
+
+Usage:
+    python load_test.py --docs 2000 --clients 8 --duration 30
+    python load_test.py --docs 500 --generate-only --folder ./load_corpus
+    python load_test.py --docs 2000 --json load_report.json
+"""
+
+import io
+import os
+import json
+import time
+import random
+import argparse
+import threading
+import contextlib
+import numpy as np
+from profiling import rss_mb
+
+TOPICS = {
+    "Vacation": ["vacation days", "holiday requests", "paid time off", "carryover days"],
+    "Remote Work": ["home office equipment", "VPN access", "core hours", "coworking stipends"],
+    "Expenses": ["meal receipts", "travel bookings", "mileage claims", "corporate cards"],
+    "Dress Code": ["business casual attire", "casual Fridays", "safety footwear", "client meetings"],
+    "Parking": ["garage passes", "visitor validation", "bike storage", "EV charging"],
+    "Security": ["badge access", "visitor sign-in", "password rotation", "laptop encryption"],
+    "Benefits": ["dental coverage", "401(k) matching", "gym reimbursement", "tuition support"],
+    "Performance": ["annual reviews", "goal setting", "promotion cycles", "peer feedback"],
+}
+ROLES = ["Employees", "Managers", "Contractors", "New hires", "Team leads", "Interns"]
+ACTIONS = ["must submit", "may request", "are eligible for", "should review", "need approval for",
+           "are reimbursed for", "can apply for", "must document"]
+CONDITIONS = ["at least two weeks in advance", "through the HR portal", "once per calendar year",
+              "with written manager approval", "within 30 days", "during open enrollment",
+              "before the end of each quarter", "according to local regulations"]
+DETAILS = ["The limit is {n} per month.", "Requests above ${n} require director sign-off.",
+           "Exceptions are reviewed within {n} business days.", "Up to {n} days may be carried over.",
+           "The program covers {n}% of eligible costs."]
+QUESTIONS = ["How do I request {item}?", "What is the policy on {item}?", "Who approves {item}?",
+             "Is there a limit for {item}?", "When can I get {item}?"]
+
+def make_sentence(rng, item):
+    """One policy-style sentence about an item"""
+    sentence = f"{rng.choice(ROLES)} {rng.choice(ACTIONS)} {item} {rng.choice(CONDITIONS)}."
+    if rng.random() < 0.4:
+        sentence += " " + rng.choice(DETAILS).format(n=rng.randint(2, 500))
+    return sentence
+
+def generate_corpus(folder, n_docs, seed=42, sections=(2, 5), paragraphs=(1, 3), sentences=(2, 6)):
+    """
+    Write n_docs markdown policy files into folder; the same seed gives the same files.
+    
+    Each file has a title, several ## sections and paragraphs of full
+    sentences, so both chunking modes see realistic boundaries.
+    """
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    # Files from an earlier, larger run would otherwise be ingested too
+    for name in os.listdir(folder):
+        if name.startswith('policy_') and name.endswith('.md'):
+            os.remove(os.path.join(folder, name))
+    topics = list(TOPICS)
+    total_bytes = 0
+    
+    for doc_index in range(n_docs):
+        topic = rng.choice(topics)
+        lines = [f"# {topic} Policy {doc_index + 1:05d}", ""]
+        for _ in range(rng.randint(*sections)):
+            item = rng.choice(TOPICS[topic])
+            lines += [f"## {item.title()}", ""]
+            for _ in range(rng.randint(*paragraphs)):
+                lines += [" ".join(make_sentence(rng, item) for _ in range(rng.randint(*sentences))), ""]
+        
+        text = "\n".join(lines)
+        with open(os.path.join(folder, f"policy_{doc_index + 1:05d}.md"), 'w') as f:
+            f.write(text)
+        total_bytes += len(text)
+    return total_bytes
+
+def generate_queries(n_queries, seed=42):
+    """Employee questions over the same vocabulary as the corpus"""
+    rng = random.Random(seed + 1)
+    items = [item for items in TOPICS.values() for item in items]
+    return [rng.choice(QUESTIONS).format(item=rng.choice(items)) for _ in range(n_queries)]
+
+class MemorySampler:
+    """Background thread recording (elapsed seconds, phase, RSS MB) at a fixed interval"""
+    
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.samples = []
+        self.phase = "startup"
+        self.started = time.perf_counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+    
+    def run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(self.interval)
+    
+    def sample(self):
+        self.samples.append((round(time.perf_counter() - self.started, 2), self.phase, round(rss_mb(), 1)))
+    
+    def __enter__(self):
+        self.thread.start()
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+
+def run_queries(collection, queries, clients, duration, n_results=3):
+    """
+    Run search_documents from `clients` threads until `duration` seconds pass.
+    
+    Returns (latencies_ms, errors, elapsed_seconds).
+    """
+    from lab4_vector_database import search_documents
+    
+    deadline = time.perf_counter() + duration
+    latencies = [[] for _ in range(clients)]
+    errors = [0] * clients
+    
+    def client(index):
+        position = index
+        while time.perf_counter() < deadline:
+            query = queries[position % len(queries)]
+            position += clients
+            start = time.perf_counter()
+            try:
+                search_documents(collection, query, n_results=n_results)
+            except Exception:
+                errors[index] += 1
+                continue
+            latencies[index].append((time.perf_counter() - start) * 1000)
+    
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [ms for per_client in latencies for ms in per_client], sum(errors), time.perf_counter() - started
+
+def run_load_test(folder, n_docs=1000, clients=4, duration=30, n_results=3, seed=42,
+                  store_path="./load_test_db", chunk_mode="characters", sample_interval=1.0):
+    """Generate, ingest and query a synthetic corpus; returns the report dict"""
+    from lab4_vector_database import setup_chromadb, load_and_chunk_documents, search_documents
+    
+    corpus_bytes = generate_corpus(folder, n_docs, seed=seed)
+    
+    with MemorySampler(sample_interval) as memory:
+        memory.phase = "ingest"
+        with contextlib.redirect_stdout(io.StringIO()):
+            _, collection = setup_chromadb(store_path=store_path)
+            start = time.perf_counter()
+            chunks = load_and_chunk_documents(folder, collection, chunk_mode=chunk_mode)
+            ingest_seconds = time.perf_counter() - start
+        
+        memory.phase = "query"
+        queries = generate_queries(1000, seed)
+        # One warm-up query loads the model outside the timed window
+        search_documents(collection, queries[0], n_results=n_results)
+        latencies, errors, query_seconds = run_queries(collection, queries, clients, duration, n_results)
+    
+    latencies = np.array(latencies)
+    if len(latencies):
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99]).tolist()
+        max_ms = float(latencies.max())
+    else:
+        # No successful queries: a zero count and no latency figures
+        p50 = p90 = p99 = max_ms = None
+    return {
+        'config': {'docs': n_docs, 'clients': clients, 'duration_s': duration, 'n_results': n_results,
+                   'seed': seed, 'chunk_mode': chunk_mode},
+        'ingest': {
+            'documents': n_docs,
+            'chunks': chunks,
+            'megabytes': corpus_bytes / 2**20,
+            'seconds': ingest_seconds,
+            'docs_per_s': n_docs / ingest_seconds,
+            'chunks_per_s': chunks / ingest_seconds
+        },
+        'queries': {
+            'count': len(latencies),
+            'errors': errors,
+            'qps': len(latencies) / query_seconds,
+            'p50_ms': p50,
+            'p90_ms': p90,
+            'p99_ms': p99,
+            'max_ms': max_ms
+        },
+        'rss_mb': [{'t': t, 'phase': phase, 'mb': mb} for t, phase, mb in memory.samples]
+    }
+
+def print_report(report):
+    """Human-readable summary of a load-test report"""
+    ingest, queries = report['ingest'], report['queries']
+    print("\n" + "=" * 70)
+    print("📈 LOAD TEST REPORT")
+    print("=" * 70)
+    print(f"\n📚 Ingest: {ingest['documents']} docs ({ingest['megabytes']:.1f} MB) -> {ingest['chunks']} chunks "
+          f"in {ingest['seconds']:.1f}s")
+    print(f"   {ingest['docs_per_s']:.1f} docs/s, {ingest['chunks_per_s']:.1f} chunks/s")
+    print(f"\n🔍 Queries: {queries['count']} from {report['config']['clients']} clients, "
+          f"{queries['qps']:.1f} QPS, {queries['errors']} errors")
+    if queries['count']:
+        print(f"   p50 {queries['p50_ms']:.1f} ms | p90 {queries['p90_ms']:.1f} ms | "
+              f"p99 {queries['p99_ms']:.1f} ms | max {queries['max_ms']:.1f} ms")
+    else:
+        print("   ⚠️  No successful queries, so there are no latency figures")
+    
+    print("\n🧠 RSS over time:")
+    samples = report['rss_mb']
+    step = max(1, len(samples) // 20)
+    for sample in samples[::step] + ([samples[-1]] if (len(samples) - 1) % step else []):
+        print(f"   {sample['t']:7.1f}s  {sample['phase']:8} {sample['mb']:8.1f} MB")
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Synthetic corpus generator and lab 4 load test")
+    parser.add_argument("--docs", type=int, default=1000, help="Number of policy files to generate")
+    parser.add_argument("--folder", default="./load_corpus", help="Where the generated corpus lives")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--clients", type=int, default=4, help="Concurrent query threads")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of sustained querying")
+    parser.add_argument("--n-results", type=int, default=3)
+    parser.add_argument("--chunk-mode", choices=["characters", "tokens"], default="characters")
+    parser.add_argument("--store", default="./load_test_db", help="ChromaDB directory (wiped each run)")
+    parser.add_argument("--sample-interval", type=float, default=1.0, help="Seconds between RSS samples")
+    parser.add_argument("--generate-only", action="store_true", help="Write the corpus and exit")
+    parser.add_argument("--json", metavar="PATH", help="Also write the report as JSON")
+    args = parser.parse_args()
+    
+    if args.generate_only:
+        total_bytes = generate_corpus(args.folder, args.docs, seed=args.seed)
+        print(f"✅ Wrote {args.docs} policy files ({total_bytes / 2**20:.1f} MB) to {args.folder}")
+        return
+    
+    print(f"🚀 Load test: {args.docs} docs, {args.clients} clients, {args.duration:.0f}s")
+    report = run_load_test(args.folder, args.docs, args.clients, args.duration, args.n_results,
+                           args.seed, args.store, args.chunk_mode, args.sample_interval)
+    print_report(report)
+    
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\n💾 Report written to {args.json}")
+
+if __name__ == "__main__":
+    main()
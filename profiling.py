@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Memory profiling for the lab pipelines
+Records tracemalloc peak, top allocation sites and RSS for each pipeline
+stage (load, chunk, embed, add, query), plus per-object byte accounting,
+and writes them as a JSON report that can be diffed between runs.
+
+Usage:
+    python lab4_vector_database.py --profile lab4_profile.json
+    python profiling.py before.json after.json    # per-stage deltas
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+import contextlib
+import numpy as np
+
+def rss_mb():
+    """Resident set size of this process in MB (peak RSS where /proc is unavailable)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+def peak_rss_mb():
+    """Highest RSS this process has reached so far in MB (None where unsupported)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 1024
+
+def deep_sizeof(obj):
+    """
+    Bytes held by obj and everything it references.
+    
+    Follows containers, instance __dict__/__slots__ and counts numpy data
+    buffers once each; shared objects are only counted the first time.
+    """
+    seen = set()
+    stack = [obj]
+    total = 0
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        
+        if isinstance(item, np.ndarray):
+            # getsizeof already includes owned data; views report only the header
+            if item.base is not None:
+                stack.append(item.base)
+        elif isinstance(item, (str, bytes, bytearray, int, float, bool, type(None))):
+            continue
+        elif isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+        else:
+            if hasattr(item, '__dict__'):
+                stack.append(item.__dict__)
+            for slot in getattr(type(item), '__slots__', ()):
+                if hasattr(item, slot):
+                    stack.append(getattr(item, slot))
+    return total
+
+def allocation_site(frame):
+    """'file:line' for a traceback frame, relative to its sys.path entry so reports diff across machines"""
+    filename = frame.filename
+    for prefix in sorted((path for path in sys.path if path), key=len, reverse=True):
+        if filename.startswith(prefix + os.sep):
+            filename = filename[len(prefix) + 1:]
+            break
+    return f"{filename}:{frame.lineno}"
+
+class Profiler:
+    """
+    Per-stage memory profiler built on tracemalloc.
+    
+    Wrap each pipeline stage in `with profiler.stage(name):`. Stages do not
+    nest (each one resets the tracemalloc peak). tracemalloc only sees
+    Python allocations (lists, dicts, numpy arrays); native buffers such as
+    Chroma's HNSW index and torch tensors show up in the RSS columns only.
+    """
+    
+    def __init__(self, top_n=10, frames=1):
+        self.top_n = top_n
+        self.frames = frames
+        self.stages = []
+        self.objects = {}
+        self.started = None
+        self.owns_tracing = False
+        self.open_stages = []   # ExitStacks from start_stage() not yet closed
+    
+    def start(self):
+        """Begin tracing (if nothing else already is)"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.owns_tracing = True
+        self.started = time.perf_counter()
+        return self
+    
+    def stop(self):
+        """Stop tracing if start() turned it on"""
+        if self.owns_tracing:
+            tracemalloc.stop()
+            self.owns_tracing = False
+    
+    def take_snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ))
+    
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Record time, traced peak/net memory, RSS and top growing allocation sites for one stage"""
+        if self.started is None:
+            self.start()
+        before = self.take_snapshot() if self.top_n else None
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        rss_before = rss_mb()
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            seconds = time.perf_counter() - start
+            current, peak = tracemalloc.get_traced_memory()
+            rss_after = rss_mb()
+            
+            top = []
+            if before is not None:
+                for stat in self.take_snapshot().compare_to(before, 'lineno')[:self.top_n]:
+                    if stat.size_diff <= 0:
+                        break
+                    top.append({
+                        'site': allocation_site(stat.traceback[0]),
+                        'size_kb': round(stat.size_diff / 1024, 1),
+                        'count': stat.count_diff
+                    })
+            
+            self.stages.append({
+                'stage': name,
+                'seconds': round(seconds, 4),
+                'traced_peak_mb': round((peak - base) / 2**20, 3),
+                'traced_net_mb': round((current - base) / 2**20, 3),
+                'rss_before_mb': round(rss_before, 1),
+                'rss_after_mb': round(rss_after, 1),
+                'process_peak_rss_mb': None if peak_rss_mb() is None else round(peak_rss_mb(), 1),
+                'top_allocations': top
+            })
+    
+    def account(self, name, value):
+        """Record bytes held by one object: a byte count or a {part: bytes, 'total': bytes} breakdown"""
+        self.objects[name] = value
+    
+    def report(self):
+        return {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'argv': sys.argv,
+            'python': sys.version.split()[0],
+            'elapsed_s': None if self.started is None else round(time.perf_counter() - self.started, 3),
+            'stages': self.stages,
+            'objects': self.objects
+        }
+    
+    def close_stages(self):
+        """Record stages left open by start_stage(), e.g. when an exception skipped their close()"""
+        for stack in self.open_stages[::-1]:
+            stack.close()
+    
+    def write(self, path):
+        """Write the JSON report (closing any open stages first) and return it"""
+        self.close_stages()
+        report = self.report()
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        return report
+    
+    def print_summary(self):
+        print("\n🧠 Memory profile by stage:")
+        for stage in self.stages:
+            print(f"   {stage['stage']:8} {stage['seconds']:8.2f}s  traced peak {stage['traced_peak_mb']:8.2f} MB  "
+                  f"net {stage['traced_net_mb']:+8.2f} MB  RSS {stage['rss_after_mb'] - stage['rss_before_mb']:+8.1f} MB")
+            for site in stage['top_allocations'][:3]:
+                print(f"            {site['size_kb']:>10,.1f} KB  {site['site']}")
+        for name, value in self.objects.items():
+            total = value['total'] if isinstance(value, dict) else value
+            print(f"   📦 {name}: {total:,} bytes")
+
+def profile_stage(profiler, name):
+    """profiler.stage(name), or a no-op context when profiling is off"""
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.stage(name)
+
+def start_stage(profiler, name):
+    """
+    Enter profile_stage(profiler, name) without a with block.
+    
+    Returns an ExitStack; close() it where the stage ends. Lets existing
+    code be profiled without reindenting it. The profiler keeps the stack
+    until it is closed, so write() still records a stage an exception
+    skipped past.
+    """
+    stack = contextlib.ExitStack()
+    if profiler is not None:
+        profiler.open_stages.append(stack)
+        stack.callback(profiler.open_stages.remove, stack)
+    stack.enter_context(profile_stage(profiler, name))
+    return stack
+
+def compare_reports(old, new):
+    """Per-stage (stage, metric, old, new, delta) rows for metrics present in both reports"""
+    old_stages = {stage['stage']: stage for stage in old['stages']}
+    rows = []
+    for stage in new['stages']:
+        previous = old_stages.get(stage['stage'])
+        if previous is None:
+            continue
+        for metric in ('seconds', 'traced_peak_mb', 'traced_net_mb'):
+            rows.append((stage['stage'], metric, previous[metric], stage[metric], stage[metric] - previous[metric]))
+    return rows
+
+def main():
+    """Print per-stage differences between two profile reports"""
+    parser = argparse.ArgumentParser(description="Compare two memory profile reports")
+    parser.add_argument("old", help="Baseline report (JSON)")
+    parser.add_argument("new", help="Report to compare against it (JSON)")
+    args = parser.parse_args()
+    
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    
+    print(f"📊 {args.old} → {args.new}")
+    for stage, metric, before, after, delta in compare_reports(old, new):
+        print(f"   {stage:8} {metric:16} {before:10.3f} → {after:10.3f}  ({delta:+.3f})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Shared similarity kernels for the labs
+Vectorized cosine, dot and L2 scoring: one-to-many, many-to-many and pairwise
+"""
+
+import threading
+import contextlib
+import numpy as np
+
+METRICS = ("cosine", "dot", "l2")
+
+# threadpoolctl controller, created on first use (inspecting loaded BLAS libraries is slow)
+thread_controller = None
+# Held for the whole of every blas_threads() region; reentrant so limits can nest
+blas_lock = threading.RLock()
+
+def as_compute_array(vectors):
+    """Return vectors as float32 for math; float16 storage is upcast on the fly"""
+    vectors = np.asarray(vectors)
+    if vectors.dtype != np.float32:
+        vectors = vectors.astype(np.float32)
+    return vectors
+
+def upcast_block(block, buffer):
+    """
+    Convert a float16 block into the front of a float32 buffer and return that view.
+    
+    NumPy's half-to-float cast is scalar code; torch (already installed with
+    sentence-transformers) has a vectorized one, so it is used when available.
+    """
+    out = buffer[:len(block)]
+    try:
+        import torch
+    except ImportError:
+        out[...] = block
+        return out
+    torch.from_numpy(out).copy_(torch.from_numpy(np.ascontiguousarray(block)))
+    return out
+
+def compute_blocks(matrix, block_size=4096):
+    """Yield (start, stop, float32 block) over matrix rows, upcasting float16 into one reused buffer"""
+    matrix = np.asarray(matrix)
+    if matrix.dtype == np.float32:
+        for start in range(0, len(matrix), block_size):
+            yield start, min(start + block_size, len(matrix)), matrix[start:start + block_size]
+        return
+    buffer = np.empty((min(block_size, len(matrix)),) + matrix.shape[1:], dtype=np.float32)
+    for start in range(0, len(matrix), block_size):
+        block = matrix[start:start + block_size]
+        if block.dtype == np.float16:
+            block = upcast_block(block, buffer)
+        else:
+            block = as_compute_array(block)
+        yield start, start + len(block), block
+
+def get_thread_controller():
+    """The shared ThreadpoolController, or None when threadpoolctl is not installed"""
+    global thread_controller
+    if thread_controller is None:
+        try:
+            from threadpoolctl import ThreadpoolController
+        except ImportError:
+            return None
+        thread_controller = ThreadpoolController()
+    return thread_controller
+
+@contextlib.contextmanager
+def locked_limit(controller, n_threads):
+    """controller.limit() held under blas_lock from entry to restore"""
+    with blas_lock:
+        with controller.limit(limits=n_threads, user_api='blas'):
+            yield
+
+def blas_threads(n_threads):
+    """
+    Context manager capping BLAS threads for the calls inside it.
+    
+    A no-op when n_threads is None or threadpoolctl is not installed. The
+    limit is process-wide and is undone by restoring the count seen on
+    entry, so overlapping regions would leave the wrong count behind;
+    regions are therefore serialized on blas_lock. To run many searches
+    concurrently, call set_blas_threads() once at startup instead.
+    """
+    if n_threads is None:
+        return contextlib.nullcontext()
+    controller = get_thread_controller()
+    if controller is None:
+        return contextlib.nullcontext()
+    return locked_limit(controller, n_threads)
+
+def set_blas_threads(n_threads):
+    """
+    Set the BLAS thread count for the whole process, with no restore.
+    
+    Meant for startup (e.g. 1 per worker when queries run in parallel
+    threads). Returns False when threadpoolctl is not installed.
+    """
+    controller = get_thread_controller()
+    if controller is None:
+        return False
+    with blas_lock:
+        controller.limit(limits=n_threads, user_api='blas')
+    return True
+
+def row_norms(matrix, block_size=4096):
+    """L2 norm of every row, computed in float32 blocks (cache the result)"""
+    norms = np.empty(len(matrix), dtype=np.float32)
+    for start, stop, block in compute_blocks(matrix, block_size):
+        norms[start:stop] = np.sqrt(np.einsum('ij,ij->i', block, block))
+    return norms
+
+def cosine_similarity(vec1, vec2):
+    """Calculate cosine similarity between two vectors"""
+    vec1 = as_compute_array(vec1)
+    vec2 = as_compute_array(vec2)
+    norm1 = np.linalg.norm(vec1)
+    norm2 = np.linalg.norm(vec2)
+    
+    if norm1 == 0 or norm2 == 0:
+        return 0.0
+    
+    return float(np.dot(vec1, vec2) / (norm1 * norm2))
+
+def _finish_scores(scores, metric, query_norms, norms, query_sq, sq_norms):
+    """Turn raw dot products into the requested metric, in place"""
+    if metric == "cosine":
+        denom = np.outer(query_norms, norms) if scores.ndim == 2 else query_norms * norms
+        np.divide(scores, denom, out=scores, where=denom != 0)
+        scores[denom == 0] = 0.0
+    elif metric == "l2":
+        # ||q - x||^2 = ||q||^2 - 2 q.x + ||x||^2
+        scores *= -2
+        if scores.ndim == 2:
+            scores += query_sq[:, None]
+            scores += sq_norms[None, :]
+        else:
+            scores += query_sq
+            scores += sq_norms
+        np.maximum(scores, 0, out=scores)
+        np.sqrt(scores, out=scores)
+    return scores
+
+def one_to_many(query, matrix, metric="cosine", norms=None, out=None, block_size=4096):
+    """
+    Score one query vector against every row of matrix.
+    
+    Args:
+        query: (dims,) vector
+        matrix: (n, dims) float32 or float16 matrix (float16 is upcast block_size rows at a time)
+        metric: "cosine" / "dot" (higher is closer) or "l2" (distance, lower is closer)
+        norms: cached row_norms(matrix), skips recomputing them per call
+        out: optional float32 (n,) buffer to write scores into
+    """
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric {metric!r}, expected one of {METRICS}")
+    query = as_compute_array(query)
+    matrix = np.asarray(matrix)
+    
+    if out is None:
+        out = np.empty(len(matrix), dtype=np.float32)
+    if matrix.dtype == np.float32:
+        np.dot(matrix, query, out=out)
+    else:
+        for start, stop, block in compute_blocks(matrix, block_size):
+            np.dot(block, query, out=out[start:stop])
+    
+    if metric == "dot":
+        return out
+    if norms is None:
+        norms = row_norms(matrix)
+    query_norm = np.float32(np.linalg.norm(query))
+    return _finish_scores(out, metric, query_norm, norms, query_norm * query_norm, norms * norms)
+
+def many_to_many(queries, matrix, metric="cosine", norms=None, block_size=4096, out=None):
+    """
+    Score every query against every row of matrix, block by block.
+    
+    Only block_size rows of matrix are upcast at a time, so float16 storage
+    never materializes a full float32 copy. Returns a (n_queries, n) array.
+    """
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric {metric!r}, expected one of {METRICS}")
+    queries = np.atleast_2d(as_compute_array(queries))
+    matrix = np.asarray(matrix)
+    
+    if out is None:
+        out = np.empty((len(queries), len(matrix)), dtype=np.float32)
+    if norms is None and metric != "dot":
+        norms = row_norms(matrix, block_size)
+    query_norms = np.linalg.norm(queries, axis=1).astype(np.float32)
+    
+    for start, stop, block in compute_blocks(matrix, block_size):
+        scores = out[:, start:stop]
+        if scores.flags.c_contiguous:
+            np.dot(queries, block.T, out=scores)
+        else:
+            scores[...] = queries @ block.T
+        if metric != "dot":
+            _finish_scores(scores, metric, query_norms, norms[start:stop],
+                           query_norms * query_norms, norms[start:stop] ** 2)
+    return out
+
+def top_k(queries, matrix, k, metric="cosine", norms=None, block_size=4096):
+    """
+    Best k rows of matrix for each query without materializing all scores.
+    
+    Memory is capped at n_queries x block_size scores. Returns
+    (indices, scores), each shaped (n_queries, k), best first.
+    """
+    queries = np.atleast_2d(as_compute_array(queries))
+    matrix = np.asarray(matrix)
+    k = min(k, len(matrix))
+    if k <= 0:
+        return np.empty((len(queries), 0), dtype=np.int64), np.empty((len(queries), 0), dtype=np.float32)
+    if norms is None and metric != "dot":
+        norms = row_norms(matrix, block_size)
+    
+    higher_is_better = metric != "l2"
+    best_scores = np.full((len(queries), 0), 0, dtype=np.float32)
+    best_ids = np.full((len(queries), 0), 0, dtype=np.int64)
+    buffer = np.empty((len(queries), min(block_size, len(matrix))), dtype=np.float32)
+    
+    for start in range(0, len(matrix), block_size):
+        stop = min(start + block_size, len(matrix))
+        scores = many_to_many(queries, matrix[start:stop], metric,
+                              norms=None if norms is None else norms[start:stop],
+                              block_size=block_size, out=buffer[:, :stop - start])
+        merged_scores = np.concatenate([best_scores, scores], axis=1)
+        merged_ids = np.concatenate(
+            [best_ids, np.broadcast_to(np.arange(start, stop), scores.shape)], axis=1)
+        if merged_scores.shape[1] > k:
+            keys = -merged_scores if higher_is_better else merged_scores
+            keep = np.argpartition(keys, k - 1, axis=1)[:, :k]
+        else:
+            keep = np.broadcast_to(np.arange(merged_scores.shape[1]), merged_scores.shape)
+        best_scores = np.take_along_axis(merged_scores, keep, axis=1)
+        best_ids = np.take_along_axis(merged_ids, keep, axis=1)
+    
+    order = np.argsort(-best_scores if higher_is_better else best_scores, axis=1, kind='stable')
+    return np.take_along_axis(best_ids, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+def rowwise(vectors_a, vectors_b, metric="cosine"):
+    """Score row i of vectors_a against row i of vectors_b (aligned pairs)"""
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric {metric!r}, expected one of {METRICS}")
+    a = np.atleast_2d(as_compute_array(vectors_a))
+    b = np.atleast_2d(as_compute_array(vectors_b))
+    
+    if metric == "l2":
+        return np.linalg.norm(a - b, axis=1)
+    scores = np.einsum('ij,ij->i', a, b)
+    if metric == "cosine":
+        denom = np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)
+        scores = np.divide(scores, denom, out=np.zeros_like(scores), where=denom != 0)
+    return scores
+
+def pairwise_matrix(vectors, metric="cosine", out=None):
+    """All-pairs similarity (or distance) matrix within one set of vectors"""
+    return many_to_many(vectors, vectors, metric, out=out)